@@ -6,42 +6,519 @@ __copyright__ = 'Copyright (c) 2018-2021 Miyata Lab.'
 
 # Standard library imports.
 import logging
+import pathlib
+import queue
 import sqlite3
 import sys
+import threading as th
+import time
+import weakref
+from concurrent.futures import Future
+
+# Related third party imports.
+import numpy as np
+
+# Local application/library specific imports.
+current_dir = pathlib.Path(__file__).resolve().parent
+sys.path.append(str(current_dir))
+import scalar_features as sf
 
 
 logger = logging.getLogger(__name__)
 
+# Pragmas applied once to each new connection. In WAL mode readers do not
+# block the writer nor the other way round, and a commit appends to the log
+# instead of rewriting the rollback journal.
+PRAGMAS = ('PRAGMA journal_mode = WAL',
+           'PRAGMA temp_store = MEMORY',
+           'PRAGMA cache_size = -8192')
+
+# Maximum number of writes committed in one transaction by the group commit
+# writer (see DBHandler.write()).
+GROUP_COMMIT_MAX = 256
+
+# Number of idle connections kept for the next threads (see
+# DBHandler.connect()).
+POOL_SIZE = 8
+
+# Storage formats of fs_x, fs_y and fp (paper.fs_format):
+#   0: comma-separated decimal text, as registered before the BLOB format.
+#   1: little-endian int16 coordinates and int8 fp.
+#   2: little-endian float32 coordinates (when they do not fit in int16) and
+#      int8 fp.
+FS_FORMAT_TEXT    = 0
+FS_FORMAT_INT16   = 1
+FS_FORMAT_FLOAT32 = 2
+FS_DTYPES = {FS_FORMAT_INT16: '<i2', FS_FORMAT_FLOAT32: '<f4'}
+FP_DTYPE  = '<i1'
+
+# Columns of paper read by features_of().
+FEATURE_COLUMNS = 'image_id, fs_x, fs_y, fh, fa, fp, fs_format'
+
+# Partial indexes of the candidates of download_file and enter_chat_room:
+# (name, column of the condition). They hold the columns filtered by
+# get_features_*_exists() and fs_format, so that only the rows of the
+# candidates are read from paper. fs_x and fs_y are left out: a piece with
+# both a file path and a chat room would store its shape three times, and
+# every write would rewrite the copies.
+CANDIDATE_INDEXES = (('paper_file_path_filter', 'file_path'),
+                     ('paper_chat_room_id_filter', 'chat_room_id'))
+CANDIDATE_INDEX_COLUMNS = 'session_id, registered_date, fp, fh, fa, fs_format'
+# Former partial indexes that also held fs_x and fs_y.
+OBSOLETE_INDEXES = ('paper_file_path_candidates', 'paper_chat_room_id_candidates')
+
+
+def encode_features(fs_x, fs_y, fp):
+    # Returns fs_x, fs_y and fp as stored in paper, and their format.
+    xs = np.asarray(fs_x, dtype=np.float64)
+    ys = np.asarray(fs_y, dtype=np.float64)
+    coordinates = np.concatenate([xs, ys])
+    integral = np.all(coordinates == np.round(coordinates))
+    if integral and np.all(np.abs(coordinates) <= np.iinfo(np.int16).max):
+        fs_format = FS_FORMAT_INT16
+    else:
+        fs_format = FS_FORMAT_FLOAT32
+    dtype = FS_DTYPES[fs_format]
+    return (xs.astype(dtype).tobytes(), ys.astype(dtype).tobytes(),
+            np.asarray(fp, dtype=np.float64).astype(FP_DTYPE).tobytes(), fs_format)
+
+
+def decode_sequence(value, fs_format):
+    if fs_format == FS_FORMAT_TEXT:
+        return np.array(value.split(','), dtype=np.float64)
+    return np.frombuffer(value, dtype=FS_DTYPES[fs_format])
+
+
+def decode_position(value, fs_format):
+    if fs_format == FS_FORMAT_TEXT:
+        return np.array(value.split(','), dtype=np.int8)
+    return np.frombuffer(value, dtype=FP_DTYPE)
+
+
+def features_of(row):
+    # The features of a row of FEATURE_COLUMNS as NumPy arrays.
+    _, fs_x, fs_y, fh, fa, fp, fs_format = row
+    return {'shape_x': decode_sequence(fs_x, fs_format),
+            'shape_y': decode_sequence(fs_y, fs_format),
+            'height': fh,
+            'angle': fa,
+            'position': decode_position(fp, fs_format)
+            }
+
+
+class ThreadConnection():
+    def __init__(self, conn):
+        # The connection a thread checked out of DBHandler. It is released
+        # when the thread exits and this holder is collected.
+        self.conn = conn
+
 
 class DBHandler():
-    def __init__(self, db_name):
+    def __init__(self, db_name, busy_timeout=5.0, group_commit=0.0):
         self.db_name = db_name
+        # Seconds a connection waits for a lock held by another one before
+        # failing with "database is locked".
+        self.busy_timeout = busy_timeout
+        # Whether the scalar features are indexed by the paper_rtree table
+        # (see setup_schema()).
+        self.rtree   = False
+        # Connection of each thread, and the idle connections left by the
+        # threads that exited (TearingServer runs each request in a thread).
+        self.local      = th.local()
+        self.idle       = []
+        self.pool_lock  = th.Lock()
+        self.pool_stats = {'opened': 0, 'closed': 0, 'reused': 0, 'calls': 0}
+        # With group_commit (seconds), the writes go through the writer
+        # thread, which commits those queued within that time together. It
+        # starts on the first write, so that the scoring workers forked at
+        # startup (see scoring_pool.py) are not forked next to it.
+        self.group_commit = group_commit
+        self.write_queue  = queue.Queue()
+        self.write_stats  = {'writes': 0, 'commits': 0}
+        self.writer       = None
 
 
-    def show_error_message(self):
-        logger.error('[%s] DatabaseError: DB is not initialized.' % sys._getframe().f_code.co_name)
+    def show_error_message(self, error=None, name=None):
+        # A lock that was not released within busy_timeout is reported as
+        # such; the other errors mean the tables are missing.
+        name = name or sys._getframe(1).f_code.co_name
+        if error is not None and ('locked' in str(error) or 'busy' in str(error)):
+            logger.error('[%s] DatabaseError: %s (busy timeout: %ss).' % (name, error, self.busy_timeout))
+            return
+        logger.error('[%s] DatabaseError: DB is not initialized.' % name)
         print('Use ./conf/init_db.sh .')
 
 
+    #====================#
+    # Connection Methods #
+    #====================#
+    def connect(self):
+        # Returns the connection of the calling thread. The first call of a
+        # thread takes an idle connection or opens a new one.
+        holder = getattr(self.local, 'holder', None)
+        if holder is None:
+            with self.pool_lock:
+                conn = self.idle.pop() if self.idle else None
+                self.pool_stats['reused' if conn is not None else 'opened'] += 1
+            if conn is None:
+                # Used by one thread at a time, but released by whichever
+                # thread collects the holder.
+                conn = self.open_connection()
+            holder = self.local.holder = ThreadConnection(conn)
+            weakref.finalize(holder, self.release, conn)
+        elif holder.conn.in_transaction:
+            # Left open by a call that failed.
+            holder.conn.rollback()
+        with self.pool_lock:
+            self.pool_stats['calls'] += 1
+        return holder.conn
+
+
+    def open_connection(self):
+        conn = sqlite3.connect(self.db_name, timeout=self.busy_timeout, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self.pool_lock:
+            if len(self.idle) < POOL_SIZE:
+                self.idle.append(conn)
+                return
+            self.pool_stats['closed'] += 1
+        conn.close()
+
+
+    def connection_stats(self):
+        # Number of open and idle connections, and how many times threads
+        # got an idle connection instead of opening one.
+        with self.pool_lock:
+            stats = dict(self.pool_stats)
+            stats['open']  = stats['opened'] - stats['closed']
+            stats['idle']  = len(self.idle)
+            stats.update(self.write_stats)
+        return stats
+
+
+    def write(self, operation, args, default=None):
+        # Runs operation(curs, *args) in a transaction and returns its result,
+        # or default if the DB fails. With group commit, the writer thread runs
+        # it along with the other queued writes and the caller waits for their
+        # commit.
+        if self.group_commit <= 0:
+            conn = self.connect()
+            curs = conn.cursor()
+            res  = default
+            try:
+                res = operation(curs, *args)
+                conn.commit()
+            except sqlite3.OperationalError as e: self.show_error_message(e, operation.__name__)
+            with self.pool_lock:
+                self.write_stats['writes']  += 1
+                self.write_stats['commits'] += 1
+            return res
+        with self.pool_lock:
+            if self.writer is None:
+                self.writer = th.Thread(target=self.writer_proc)
+                self.writer.daemon = True
+                self.writer.start()
+        future = Future()
+        self.write_queue.put((operation, args, default, future))
+        return future.result()
+
+
+    def writer_proc(self):
+        conn = self.open_connection()
+        while True:
+            batch = [self.write_queue.get()]
+            deadline = time.monotonic() + self.group_commit
+            while len(batch) < GROUP_COMMIT_MAX:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.write_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # Each write has its own savepoint so that a failing one does not
+            # undo the others.
+            outcomes = []
+            try:
+                curs = conn.cursor()
+                curs.execute('BEGIN IMMEDIATE')
+                for operation, args, default, _ in batch:
+                    curs.execute('SAVEPOINT write')
+                    try:
+                        outcomes.append((True, operation(curs, *args)))
+                    except sqlite3.OperationalError as e:
+                        curs.execute('ROLLBACK TO write')
+                        self.show_error_message(e, operation.__name__)
+                        outcomes.append((True, default))
+                    except Exception as e:
+                        curs.execute('ROLLBACK TO write')
+                        outcomes.append((False, e))
+                    curs.execute('RELEASE write')
+                curs.execute('COMMIT')
+            except Exception as e:
+                # The whole batch is rolled back. Its writes get their default
+                # if the DB failed, and the error otherwise; the thread goes on
+                # with the next batch.
+                try:
+                    if conn.in_transaction:
+                        conn.rollback()
+                except sqlite3.Error as rollback_error:
+                    self.show_error_message(rollback_error, 'writer_proc')
+                if isinstance(e, sqlite3.OperationalError):
+                    self.show_error_message(e, 'writer_proc')
+                    outcomes = [(True, default) for _, _, default, _ in batch]
+                else:
+                    logger.exception('writer_proc: the batch of {} writes failed.'.format(len(batch)))
+                    outcomes = [(False, e) for _ in batch]
+            with self.pool_lock:
+                self.write_stats['writes']  += len(batch)
+                self.write_stats['commits'] += 1
+            for (_, _, _, future), (ok, value) in zip(batch, outcomes):
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+
+    #==============#
+    # Setup Method #
+    #==============#
+    def setup_schema(self):
+        # Creates the tables derived from paper on an existing DB and fills
+        # them in for the rows registered before. If SQLite was built without
+        # the R*Tree module, the scalar features are filtered on paper itself.
+        # The session_id and fs_format columns are added to DBs created
+        # without them (the rows there keep the text format until
+        # migrate_features() converts them). The rankings of the match
+        # commands are kept in match_result, valid as long as the version of
+        # their command in match_version (bumped by triggers whenever the
+        # candidates of that command change) is the same.
+        conn = self.connect()
+        curs = conn.cursor()
+        try:
+            columns = [row[1] for row in curs.execute('PRAGMA table_info(paper)')]
+            if columns and 'session_id' not in columns:
+                curs.execute('''
+                    ALTER TABLE paper ADD COLUMN session_id TEXT DEFAULT ''
+                ''')
+                logger.info('paper: session_id column added')
+            if columns and 'fs_format' not in columns:
+                curs.execute('''
+                    ALTER TABLE paper ADD COLUMN fs_format INTEGER DEFAULT 0
+                ''')
+                logger.info('paper: fs_format column added')
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+        try:
+            curs.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS paper_rtree USING rtree(
+                    image_id, min_fh, max_fh, min_fa, max_fa, min_width, max_width,
+                    min_length, max_length, min_tilt, max_tilt)
+            ''')
+            self.rtree = True
+        except sqlite3.OperationalError as e:
+            logger.warning('R*Tree is not available ({}); scalar features are not indexed.'.format(e))
+            self.rtree = False
+        try:
+            curs.execute('''
+                CREATE INDEX IF NOT EXISTS paper_fp ON paper(fp)
+            ''')
+            curs.execute('''
+                CREATE INDEX IF NOT EXISTS paper_registered_date ON paper(registered_date)
+            ''')
+            curs.execute('''
+                CREATE INDEX IF NOT EXISTS paper_session_id ON paper(session_id)
+            ''')
+            self.setup_candidate_indexes(curs)
+            if self.rtree:
+                curs.execute('''
+                    SELECT {} FROM paper
+                    WHERE image_id NOT IN (SELECT image_id FROM paper_rtree)
+                '''.format(FEATURE_COLUMNS))
+                rows = curs.fetchall()
+                for row in rows:
+                    features = features_of(row)
+                    self.insert_scalar_features(curs, row[0], features['shape_x'], features['shape_y'],
+                                                features['height'], features['angle'])
+                logger.info('paper_rtree: {} rows added'.format(len(rows)))
+            conn.commit()
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+        try:
+            curs.execute('''
+                CREATE TABLE IF NOT EXISTS match_result(
+                    cmd TEXT,
+                    query_id INTEGER,
+                    rank INTEGER,
+                    matched_id INTEGER,
+                    score FLOAT,
+                    norm_score FLOAT,
+                    version INTEGER,
+                    PRIMARY KEY (cmd, query_id, rank))
+            ''')
+            curs.execute('''
+                CREATE TABLE IF NOT EXISTS match_version(
+                    cmd TEXT PRIMARY KEY,
+                    version INTEGER)
+            ''')
+            curs.execute('''
+                INSERT OR IGNORE INTO match_version (cmd, version)
+                VALUES ('download_file', 0), ('enter_chat_room', 0)
+            ''')
+            # download_file matches against the pieces with a file_path and
+            # enter_chat_room against those with a chat_room_id.
+            curs.execute('''
+                CREATE TRIGGER IF NOT EXISTS paper_insert_version AFTER INSERT ON paper
+                BEGIN
+                    UPDATE match_version SET version = version + 1
+                    WHERE (cmd = 'download_file' AND NEW.file_path != '')
+                       OR (cmd = 'enter_chat_room' AND NEW.chat_room_id != '');
+                END
+            ''')
+            curs.execute('''
+                CREATE TRIGGER IF NOT EXISTS paper_file_path_version AFTER UPDATE OF file_path ON paper
+                WHEN NEW.file_path IS NOT OLD.file_path
+                BEGIN
+                    UPDATE match_version SET version = version + 1 WHERE cmd = 'download_file';
+                END
+            ''')
+            curs.execute('''
+                CREATE TRIGGER IF NOT EXISTS paper_chat_room_id_version AFTER UPDATE OF chat_room_id ON paper
+                WHEN NEW.chat_room_id IS NOT OLD.chat_room_id
+                BEGIN
+                    UPDATE match_version SET version = version + 1 WHERE cmd = 'enter_chat_room';
+                END
+            ''')
+            curs.execute('''
+                CREATE TRIGGER IF NOT EXISTS paper_delete_version AFTER DELETE ON paper
+                BEGIN
+                    UPDATE match_version SET version = version + 1;
+                    DELETE FROM match_result WHERE query_id = OLD.image_id;
+                END
+            ''')
+            # The chat room each piece got on enter_chat_room, so that a retried
+            # request gets the same room (see claim_chat_room_id_by_image_id()).
+            curs.execute('''
+                CREATE TABLE IF NOT EXISTS chat_room_claim(
+                    image_id INTEGER PRIMARY KEY,
+                    partner_id INTEGER,
+                    chat_room_id TEXT)
+            ''')
+            curs.execute('''
+                CREATE TRIGGER IF NOT EXISTS paper_delete_claim AFTER DELETE ON paper
+                BEGIN
+                    DELETE FROM chat_room_claim WHERE image_id = OLD.image_id;
+                END
+            ''')
+            conn.commit()
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+
+
+    def setup_candidate_indexes(self, curs):
+        # Creates the partial indexes of CANDIDATE_INDEXES in place of the
+        # OBSOLETE_INDEXES.
+        for name in OBSOLETE_INDEXES:
+            curs.execute('DROP INDEX IF EXISTS {}'.format(name))
+        for name, column in CANDIDATE_INDEXES:
+            curs.execute('''
+                CREATE INDEX IF NOT EXISTS {0} ON paper({1}, {2})
+                WHERE {2} != ''
+            '''.format(name, CANDIDATE_INDEX_COLUMNS, column))
+
+
+    def migrate_features(self, batch_size=1000):
+        # Converts the rows stored in the text format to the BLOB format, a
+        # batch per transaction. Returns the number of rows converted.
+        conn  = self.connect()
+        curs  = conn.cursor()
+        count = 0
+        last_id = 0
+        try:
+            while True:
+                curs.execute('''
+                    SELECT {} FROM paper
+                    WHERE image_id > ? AND fs_format = ?
+                    ORDER BY image_id
+                    LIMIT ?
+                '''.format(FEATURE_COLUMNS), (last_id, FS_FORMAT_TEXT, batch_size))
+                rows = curs.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                updates = []
+                for row in rows:
+                    features = features_of(row)
+                    fs_x, fs_y, fp, fs_format = encode_features(features['shape_x'], features['shape_y'], features['position'])
+                    updates.append((fs_x, fs_y, fp, fs_format, row[0]))
+                curs.executemany('''
+                    UPDATE paper
+                    SET fs_x = ?, fs_y = ?, fp = ?, fs_format = ?
+                    WHERE image_id = ?
+                ''', updates)
+                conn.commit()
+                count += len(rows)
+                logger.info('paper: {} rows converted'.format(count))
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+        return count
+
+
+    def insert_scalar_features(self, curs, image_id, fs_x, fs_y, fh, fa):
+        values = sf.scalar_features(fs_x, fs_y, fh, fa)
+        bounds = [value for name in sf.SCALAR_NAMES for value in (values[name], values[name])]
+        curs.execute('''
+            INSERT OR REPLACE INTO paper_rtree
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (image_id, *bounds))
+
+
+    def box_condition(self, box):
+        # SQL condition and parameters selecting the rows of paper whose
+        # scalar features lie in box, a dict of (low, high) keyed by
+        # scalar_features.SCALAR_NAMES. Without R*Tree only fh and fa are
+        # filtered.
+        conditions, params = [], []
+        for name in sf.SCALAR_NAMES:
+            if name not in box:
+                continue
+            if self.rtree:
+                conditions.append('(max_{0} >= ? AND min_{0} <= ?)'.format(name))
+            elif name in ('fh', 'fa'):
+                conditions.append('({0} >= ? AND {0} <= ?)'.format(name))
+            else:
+                continue
+            params.extend(box[name])
+        if not conditions:
+            return '1', params
+        if self.rtree:
+            return 'image_id IN (SELECT image_id FROM paper_rtree WHERE {})'.format(' AND '.join(conditions)), params
+        return ' AND '.join(conditions), params
+
+
     #=================#
     # Register Method #
     #=================#
-    def register_and_get_image_id(self, registered_date, fs_x, fs_y, fh, fa, fp, file_path, chat_room_id):
-        conn     = sqlite3.connect(self.db_name)
-        curs     = conn.cursor()
-        res      = -1
-        fs_x_str = ",".join(map(str, fs_x))
-        fs_y_str = ",".join(map(str, fs_y))
-        fp_str   = ",".join(map(str, fp))
-        try:
-            curs.execute('''
-                INSERT INTO paper (registered_date, fs_x, fs_y, fh, fa, fp, file_path, chat_room_id)
-                VALUES ('%s', '%s', '%s', '%f', '%f', '%s', '%s', '%s')
-            ''' % (registered_date, fs_x_str, fs_y_str, fh, fa, fp_str, file_path, chat_room_id))
-            res = curs.lastrowid
-            conn.commit()
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+    def register_and_get_image_id(self, registered_date, fs_x, fs_y, fh, fa, fp, file_path, chat_room_id, session_id=''):
+        return self.write(self.insert_paper,
+                          (registered_date, fs_x, fs_y, fh, fa, fp, file_path, chat_room_id, session_id), -1)
+
+
+    def insert_paper(self, curs, registered_date, fs_x, fs_y, fh, fa, fp, file_path, chat_room_id, session_id):
+        fs_x_blob, fs_y_blob, fp_blob, fs_format = encode_features(fs_x, fs_y, fp)
+        # fh and fa are stored with 6 decimals.
+        fh, fa = float('%f' % fh), float('%f' % fa)
+        curs.execute('''
+            INSERT INTO paper (registered_date, fs_x, fs_y, fh, fa, fp, file_path, chat_room_id, session_id, fs_format)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (str(registered_date), fs_x_blob, fs_y_blob, fh, fa, fp_blob, file_path, chat_room_id, session_id,
+              fs_format))
+        res = curs.lastrowid
+        if self.rtree:
+            self.insert_scalar_features(curs, res, fs_x, fs_y, fh, fa)
         return res
 
 
@@ -49,169 +526,326 @@ class DBHandler():
     # Set Methods #
     #=============#
     def set_file_path_by_image_id(self, image_id, file_path):
-        conn = sqlite3.connect(self.db_name)
+        self.write(self.update_file_path, (image_id, file_path))
+
+
+    def update_file_path(self, curs, image_id, file_path):
+        curs.execute('''
+            UPDATE paper
+            SET file_path = ?
+            WHERE image_id = ?
+        ''', (file_path, image_id))
+
+
+    def set_chat_room_id_by_image_id(self, image_id, chat_room_id):
+        self.write(self.update_chat_room_id, (image_id, chat_room_id))
+
+
+    def update_chat_room_id(self, curs, image_id, chat_room_id):
+        curs.execute('''
+            UPDATE paper
+            SET chat_room_id = ?
+            WHERE image_id = ?
+        ''', (chat_room_id, image_id))
+
+
+    def claim_chat_room_id_by_image_id(self, image_id, claimer_id=None):
+        # Reads and clears chat_room_id in one transaction so that a chat room
+        # is handed to one partner only. Returns '' if it was already claimed.
+        # The room claimer_id gets is recorded, and a claimer that already got
+        # one gets that room again instead of claiming another.
+        conn = self.connect()
         curs = conn.cursor()
+        res  = ''
         try:
-            curs.execute('''
-                UPDATE paper
-                SET file_path = '%s'
-                WHERE image_id = %d
-            ''' % (file_path, image_id))
-            conn.commit()
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+            curs.execute('BEGIN IMMEDIATE')
+            row = None
+            if claimer_id is not None:
+                curs.execute('''
+                    SELECT chat_room_id FROM chat_room_claim
+                    WHERE image_id = ?
+                ''', (claimer_id,))
+                row = curs.fetchone()
+            if row is not None:
+                res = row[0]
+            else:
+                curs.execute('''
+                    SELECT chat_room_id FROM paper
+                    WHERE image_id = ?
+                ''', (image_id,))
+                row = curs.fetchone()
+                if row is not None and row[0] != '':
+                    curs.execute('''
+                        UPDATE paper
+                        SET chat_room_id = ''
+                        WHERE image_id = ?
+                    ''', (image_id,))
+                    res = row[0]
+                    if claimer_id is not None:
+                        curs.execute('''
+                            INSERT INTO chat_room_claim (image_id, partner_id, chat_room_id)
+                            VALUES (?, ?, ?)
+                        ''', (claimer_id, image_id, res))
+            curs.execute('COMMIT')
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.rollback()
+            self.show_error_message(e)
+        return res
 
 
-    def set_chat_room_id_by_image_id(self, image_id, chat_room_id):
-        conn = sqlite3.connect(self.db_name)
+    def set_match_result(self, cmd, query_id, version, ranking):
+        # Replaces the kept ranking of query_id for cmd. ranking is a list of
+        # (matched_id, score, norm_score) computed at version.
+        self.write(self.replace_match_result, (cmd, query_id, version, ranking))
+
+
+    def replace_match_result(self, curs, cmd, query_id, version, ranking):
+        curs.execute('''
+            DELETE FROM match_result
+            WHERE cmd = ? AND query_id = ?
+        ''', (cmd, query_id))
+        curs.executemany('''
+            INSERT INTO match_result (cmd, query_id, rank, matched_id, score, norm_score, version)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(cmd, query_id, rank, matched_id, score, norm_score, version)
+              for rank, (matched_id, score, norm_score) in enumerate(ranking)])
+
+
+    #================#
+    # Delete Methods #
+    #================#
+    def delete_session(self, session_id):
+        # Deletes the pieces of session_id and returns their image IDs.
+        conn = self.connect()
         curs = conn.cursor()
+        res  = []
         try:
             curs.execute('''
-                UPDATE paper
-                SET chat_room_id = '%s'
-                WHERE image_id = %d
-            ''' % (chat_room_id, image_id))
+                SELECT image_id FROM paper
+                WHERE session_id = ?
+            ''', (session_id,))
+            res = [row[0] for row in curs.fetchall()]
+            if self.rtree:
+                curs.execute('''
+                    DELETE FROM paper_rtree
+                    WHERE image_id IN (SELECT image_id FROM paper WHERE session_id = ?)
+                ''', (session_id,))
+            curs.execute('''
+                DELETE FROM paper
+                WHERE session_id = ?
+            ''', (session_id,))
             conn.commit()
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+        return res
 
 
     #=============#
     # Get Methods #
     #=============#
     def get_all_features(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         curs = conn.cursor()
         res  = {}
         try:
             curs.execute('''
-                SELECT * FROM paper
-            ''')
+                SELECT {} FROM paper
+            '''.format(FEATURE_COLUMNS))
             conn.commit()
-            res = {row[0]:{'shape_x':row[2],
-                           'shape_y':row[3],
-                           'height':row[4],
-                           'angle':row[5],
-                           'position':row[6]
-                           } for row in curs.fetchall()}
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+            res = {row[0]: features_of(row) for row in curs.fetchall()}
+        except sqlite3.OperationalError as e: self.show_error_message(e)
         return res
 
 
-    def get_features_file_path_exists(self):
-        conn = sqlite3.connect(self.db_name)
+    def get_features_file_path_exists(self, box=None, fp=None, since=None, session_id=None):
+        # box narrows the rows down to the scalar features in it (see
+        # box_condition()), fp to the pieces of the same fp, since to the
+        # pieces registered at or after that datetime and session_id to the
+        # pieces of that session.
+        conn = self.connect()
         curs = conn.cursor()
         res = ''
+        condition, params = self.box_condition(box or {})
+        if fp is not None:
+            # Rows not migrated yet keep fp as text.
+            condition += ' AND fp IN (?, ?)'
+            params.extend([",".join(map(str, fp)), encode_features([], [], fp)[2]])
+        if since is not None:
+            condition += ' AND registered_date >= ?'
+            params.append(str(since))
+        if session_id is not None:
+            condition += ' AND session_id = ?'
+            params.append(session_id)
         try:
             curs.execute('''
-                SELECT * FROM paper
-                WHERE file_path != ''
-            ''')
+                SELECT {} FROM paper
+                WHERE file_path != '' AND {}
+            '''.format(FEATURE_COLUMNS, condition), params)
             conn.commit()
-            res = {row[0]: {'shape_x': row[2],
-                            'shape_y': row[3],
-                            'height': row[4],
-                            'angle': row[5],
-                            'position': row[6]
-                            } for row in curs.fetchall()}
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+            res = {row[0]: features_of(row) for row in curs.fetchall()}
+        except sqlite3.OperationalError as e: self.show_error_message(e)
         return res
 
 
-    def get_features_chat_room_id_exists(self):
-        conn = sqlite3.connect(self.db_name)
+    def get_features_chat_room_id_exists(self, box=None, fp=None, since=None, session_id=None):
+        # box narrows the rows down to the scalar features in it (see
+        # box_condition()), fp to the pieces of the same fp, since to the
+        # pieces registered at or after that datetime and session_id to the
+        # pieces of that session.
+        conn = self.connect()
         curs = conn.cursor()
         res = ''
+        condition, params = self.box_condition(box or {})
+        if fp is not None:
+            # Rows not migrated yet keep fp as text.
+            condition += ' AND fp IN (?, ?)'
+            params.extend([",".join(map(str, fp)), encode_features([], [], fp)[2]])
+        if since is not None:
+            condition += ' AND registered_date >= ?'
+            params.append(str(since))
+        if session_id is not None:
+            condition += ' AND session_id = ?'
+            params.append(session_id)
         try:
             curs.execute('''
-                SELECT * FROM paper
-                WHERE chat_room_id != ''
-            ''')
+                SELECT {} FROM paper
+                WHERE chat_room_id != '' AND {}
+            '''.format(FEATURE_COLUMNS, condition), params)
             conn.commit()
-            res = {row[0]: {'shape_x': row[2],
-                            'shape_y': row[3],
-                            'height': row[4],
-                            'angle': row[5],
-                            'position': row[6]
-                            } for row in curs.fetchall()}
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+            res = {row[0]: features_of(row) for row in curs.fetchall()}
+        except sqlite3.OperationalError as e: self.show_error_message(e)
         return res
 
 
     def get_features_by_image_id(self, image_id):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         curs = conn.cursor()
         res  = ''
         try:
             curs.execute('''
-                SELECT * FROM paper
-                WHERE image_id = %d
-            ''' % image_id)
+                SELECT {} FROM paper
+                WHERE image_id = ?
+            '''.format(FEATURE_COLUMNS), (image_id,))
             conn.commit()
-            res = curs.fetchone()
-            res = {'shape_x': list(map(float, res[2].split(','))),
-                   'shape_y': list(map(float, res[3].split(','))),
-                   'height': res[4],
-                   'angle': res[5],
-                   'position': list(map(int, res[6].split(',')))
-                   }
+            res = features_of(curs.fetchone())
         except sqlite3.OperationalError as e:
             print(e)
-            self.show_error_message()
-        conn.close()
+            self.show_error_message(e)
         return res
 
 
     def get_registered_date_by_image_id(self, image_id):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         curs = conn.cursor()
         res  = ''
         try:
             curs.execute('''
                 SELECT registered_date FROM paper
-                WHERE image_id = %d
-            ''' % image_id)
+                WHERE image_id = ?
+            ''', (image_id,))
             conn.commit()
             res = curs.fetchone()[0]
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+        return res
+
+
+    def get_match_version(self, cmd):
+        conn = self.connect()
+        curs = conn.cursor()
+        res  = 0
+        try:
+            curs.execute('''
+                SELECT version FROM match_version
+                WHERE cmd = ?
+            ''', (cmd,))
+            res = curs.fetchone()
+            res = res[0] if res is not None else 0
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+        return res
+
+
+    def get_match_result(self, cmd, query_id, version):
+        # Returns the kept ranking of query_id for cmd if it was computed at
+        # version, and None otherwise.
+        conn = self.connect()
+        curs = conn.cursor()
+        res  = None
+        try:
+            curs.execute('''
+                SELECT matched_id, score, norm_score FROM match_result
+                WHERE cmd = ? AND query_id = ? AND version = ?
+                ORDER BY rank
+            ''', (cmd, query_id, version))
+            res = curs.fetchall() or None
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+        return res
+
+
+    def get_claimed_chat_room_id_by_image_id(self, image_id):
+        # The chat room image_id got on enter_chat_room, or ''.
+        conn = self.connect()
+        curs = conn.cursor()
+        res  = ''
+        try:
+            curs.execute('''
+                SELECT chat_room_id FROM chat_room_claim
+                WHERE image_id = ?
+            ''', (image_id,))
+            conn.commit()
+            row = curs.fetchone()
+            res = row[0] if row is not None else ''
+        except sqlite3.OperationalError as e: self.show_error_message(e)
+        return res
+
+
+    def get_session_id_by_image_id(self, image_id):
+        conn = self.connect()
+        curs = conn.cursor()
+        res  = ''
+        try:
+            curs.execute('''
+                SELECT session_id FROM paper
+                WHERE image_id = ?
+            ''', (image_id,))
+            conn.commit()
+            res = curs.fetchone()
+            if res is not None:
+                res = res[0]
+            else:
+                res = ''
+        except sqlite3.OperationalError as e: self.show_error_message(e)
         return res
 
 
     def get_file_path_by_image_id(self, image_id):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         curs = conn.cursor()
         res  = ''
         try:
             curs.execute('''
                 SELECT file_path FROM paper
-                WHERE image_id = %d
-            ''' % image_id)
+                WHERE image_id = ?
+            ''', (image_id,))
             conn.commit()
             res = curs.fetchone()[0]
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+        except sqlite3.OperationalError as e: self.show_error_message(e)
         return res
 
 
     def get_chat_room_id_by_image_id(self, image_id):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.connect()
         curs = conn.cursor()
         res  = ''
         try:
             curs.execute('''
                 SELECT chat_room_id FROM paper
-                WHERE image_id = %d
-            ''' % image_id)
+                WHERE image_id = ?
+            ''', (image_id,))
             conn.commit()
             res = curs.fetchone()
             if res is not None:
                 res = res[0]
             else:
                 res = ''
-        except sqlite3.OperationalError: self.show_error_message()
-        conn.close()
+        except sqlite3.OperationalError as e: self.show_error_message(e)
         return res
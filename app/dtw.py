@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__    = 'Shion Tominaga and Akihiro Miyata'
+__copyright__ = 'Copyright (c) 2018-2021 Miyata Lab.'
+
+# Standard library imports.
+import logging
+import time
+
+# Related third party imports.
+import numpy as np
+from fastdtw import fastdtw
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+logger = logging.getLogger(__name__)
+
+# Number of anti-diagonals between two checks for abandoning the wavefront.
+ABANDON_INTERVAL = 16
+
+
+def band_radius(n, m, band):
+    # The Sakoe-Chiba band is given as a ratio of the longer sequence. It is
+    # widened to the slope of the diagonal so that a warping path always exists.
+    if band is None:
+        return max(n, m)
+    radius = int(np.ceil(band * max(n, m)))
+    slope  = int(np.ceil(max(n, m) / max(min(n, m), 1)))
+    return max(radius, slope, 1)
+
+
+def band_window(n, m, band):
+    # Returns the first and last column (inclusive) allowed in each row.
+    radius = band_radius(n, m, band)
+    center = np.arange(n) * ((m - 1) / (n - 1)) if n > 1 else np.zeros(1)
+    lo = np.clip(np.floor(center - radius), 0, m - 1).astype(np.int64)
+    hi = np.clip(np.ceil(center + radius), 0, m - 1).astype(np.int64)
+    return lo, hi
+
+
+def local_cost(a, b, multivariate):
+    # Absolute difference of scalars, or Euclidean distance of points stored
+    # along the last axis of multivariate sequences.
+    if multivariate:
+        return np.sqrt(np.square(a - b).sum(axis=-1))
+    return np.abs(a - b)
+
+
+def paa(x, factor):
+    # Piecewise aggregate approximation: the mean of every factor points (the
+    # last segment may be shorter).
+    x = np.asarray(x)
+    if factor <= 1 or len(x) == 0:
+        return x
+    starts = np.arange(0, len(x), factor)
+    counts = np.diff(np.append(starts, len(x))).reshape((-1,) + (1,) * (x.ndim - 1))
+    return (np.add.reduceat(x, starts, axis=0) / counts).astype(x.dtype)
+
+
+def lb_kim(x, y):
+    # Every warping path starts and ends at the first and last elements.
+    multivariate = np.ndim(x) > 1
+    if len(x) == 1 and len(y) == 1:
+        return float(local_cost(x[0], y[0], multivariate))
+    return float(local_cost(x[0], y[0], multivariate) + local_cost(x[-1], y[-1], multivariate))
+
+
+def sliding_extreme(x, width, accumulate, fill):
+    # accumulate (np.minimum or np.maximum) over every window x[j:j + width]
+    # in O(len(x)): the extreme of a window is that of the suffix of the block
+    # it starts in and of the prefix of the next block (van Herk/Gil-Werman).
+    count  = len(x) - width + 1
+    blocks = -(-len(x) // width)
+    padded = np.concatenate([x, np.full((blocks * width - len(x),) + x.shape[1:], fill, dtype=x.dtype)])
+    padded = padded.reshape((blocks, width) + x.shape[1:])
+    prefix = accumulate.accumulate(padded, axis=1).reshape((-1,) + x.shape[1:])
+    suffix = accumulate.accumulate(padded[:, ::-1], axis=1)[:, ::-1].reshape((-1,) + x.shape[1:])
+    return accumulate(suffix[:count], prefix[width - 1:width - 1 + count])
+
+
+def envelope(y, n, band):
+    # Lower and upper envelopes of y seen from each of the n query rows. The
+    # windows are padded to a common width, which only loosens the bound.
+    y = np.asarray(y, dtype=np.float64)
+    lo, hi = band_window(n, len(y), band)
+    width  = int((hi - lo).max()) + 1
+    padded = np.concatenate([y, np.repeat(y[-1:], width - 1, axis=0)])
+    return (sliding_extreme(padded, width, np.minimum, np.inf)[lo],
+            sliding_extreme(padded, width, np.maximum, -np.inf)[lo])
+
+
+def lb_keogh(x, lower, upper):
+    # For multivariate sequences the envelopes are boxes and each point is
+    # charged its Euclidean distance to the box.
+    excess = np.maximum(x - upper, 0) + np.maximum(lower - x, 0)
+    if np.ndim(x) > 1:
+        return float(np.sqrt(np.square(excess).sum(axis=1)).sum())
+    return float(excess.sum())
+
+
+def dtw_rows(x, y, band=None, max_cost=np.inf):
+    # Exact DTW restricted to a Sakoe-Chiba band (see local_cost()).
+    # Each row is solved at once with the prefix-sum form of the horizontal
+    # recurrence. The computation is abandoned (returning inf) as soon as a
+    # whole row exceeds max_cost, since every path crosses every row.
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n, m = len(x), len(y)
+    multivariate = x.ndim > 1
+    lo, hi = band_window(n, m, band)
+
+    # prev[j + 1] holds D[i - 1, j]; prev[0] is the virtual D[-1, -1].
+    prev = np.full(m + 1, np.inf)
+    prev[0] = 0.0
+    curr = np.full(m + 1, np.inf)
+    for i in range(n):
+        l, h = lo[i], hi[i] + 1
+        cost = local_cost(x[i], y[l:h], multivariate)
+        step = cost + np.minimum(prev[l:h], prev[l + 1:h + 1])
+        cumsum = np.cumsum(cost)
+        row = cumsum + np.minimum.accumulate(step - cumsum)
+        if row.min() > max_cost:
+            return np.inf
+        curr.fill(np.inf)
+        curr[l + 1:h + 1] = row
+        prev, curr = curr, prev
+    return float(prev[m])
+
+
+def dtw_wavefront(x, y, band=None, max_cost=np.inf):
+    # Exact banded DTW computed one anti-diagonal (i + j = d) at a time. All the
+    # cells of an anti-diagonal depend only on the two previous ones, so each
+    # step is a single vectorized update. A path visits at least one of any two
+    # consecutive anti-diagonals, which gives the abandoning condition.
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n, m = len(x), len(y)
+    multivariate = x.ndim > 1
+    lo, hi = band_window(n, m, band)
+
+    # The rows crossing anti-diagonal d are start[d] <= i < stop[d].
+    rows  = np.arange(n)
+    diags = np.arange(n + m - 1)
+    start = np.searchsorted(rows + hi, diags, 'left')
+    stop  = np.searchsorted(rows + lo, diags, 'right')
+
+    # Each buffer holds D[i, d - i] at index i + 1; index 0 is the virtual row
+    # -1, whose only finite cell is D[-1, -1] = 0 on anti-diagonal -2.
+    prev2 = np.full(n + 1, np.inf)
+    prev1 = np.full(n + 1, np.inf)
+    curr  = np.full(n + 1, np.inf)
+    prev2[0] = 0.0
+    prev2_range, prev1_range = (0, 1), (0, 0)
+    for d in range(n + m - 1):
+        a, b = start[d], stop[d]
+        cost = local_cost(x[a:b], y[d - b + 1:d - a + 1][::-1], multivariate)
+        best = np.minimum(np.minimum(prev2[a:b], prev1[a:b]), prev1[a + 1:b + 1])
+        curr[a + 1:b + 1] = cost + best
+        if max_cost < np.inf and d % ABANDON_INTERVAL == 0:
+            if min(curr[a + 1:b + 1].min(), prev1[slice(*prev1_range)].min(initial=np.inf)) > max_cost:
+                return np.inf
+        # The oldest buffer is reused; only its written cells need clearing.
+        prev2[slice(*prev2_range)] = np.inf
+        prev2, prev1, curr = prev1, curr, prev2
+        prev2_range, prev1_range = prev1_range, (a + 1, b + 1)
+    return float(prev1[n])
+
+
+def dtw_batch(x, ys, band=None, max_costs=None):
+    # Exact banded DTW of x against every sequence of ys at once. The rows of
+    # all the candidates advance in lockstep; each row is kept in band
+    # coordinates (column lo[k, i] + t) and padded to a common width W, so the
+    # work per query row is O(len(ys) * W) in NumPy, not a Python loop. With
+    # max_costs, the sequences whose whole row exceeds their max cost are
+    # dropped from the batch (every ABANDON_INTERVAL rows) and get inf.
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+    num = len(ys)
+    multivariate = x.ndim > 1
+    lengths = np.array([len(y) for y in ys], dtype=np.int64)
+    padded  = np.zeros((num, lengths.max()) + x.shape[1:])
+    lo = np.empty((num, n), dtype=np.int64)
+    hi = np.empty((num, n), dtype=np.int64)
+    for k, y in enumerate(ys):
+        padded[k, :lengths[k]] = y
+        lo[k], hi[k] = band_window(n, lengths[k], band)
+
+    width = int((hi - lo).max()) + 1
+    shift = np.diff(lo, axis=1, prepend=0)
+    rows  = np.arange(num)
+    cols  = np.arange(width)
+    pad_width = ((0, 0), (0, width)) + ((0, 0),) * (x.ndim - 1)
+    # windows[k, j] is padded[k, j:j + width], points first.
+    windows = np.moveaxis(sliding_window_view(np.pad(padded, pad_width), width, axis=1), -1, 2)
+    # prev[k, t + 1] holds D[i - 1, lo[k, i - 1] + t]; column 0 is t = -1 and
+    # the extra columns on the right absorb the shift to the next row.
+    prev = np.full((num, width + int(shift.max()) + 2), np.inf)
+    prev[:, 0] = 0.0
+    prev_windows = sliding_window_view(prev, width + 1, axis=1)
+    # active[r] is the sequence of ys in row r of prev.
+    active = rows
+    for i in range(n):
+        cost  = local_cost(x[i], windows[active, lo[active, i]], multivariate)
+        above = prev_windows[rows, shift[active, i]]
+        step  = cost + np.minimum(above[:, :-1], above[:, 1:])
+        cumsum = np.cumsum(cost, axis=1)
+        row = cumsum + np.minimum.accumulate(step - cumsum, axis=1)
+        # Cells right of hi[k, i] only feed cells further right, so it is
+        # enough to clear them once the row is done.
+        row[cols > (hi[active, i] - lo[active, i])[:, None]] = np.inf
+        prev[:, 0] = np.inf
+        prev[:, 1:width + 1] = row
+        if max_costs is not None and i % ABANDON_INTERVAL == 0:
+            alive = row.min(axis=1) <= max_costs[active]
+            if not alive.all():
+                active = active[alive]
+                prev   = prev[alive]
+                prev_windows = sliding_window_view(prev, width + 1, axis=1)
+                rows = np.arange(len(active))
+                if len(active) == 0:
+                    break
+    res = np.full(num, np.inf)
+    res[active] = prev[rows, lengths[active] - lo[active, -1]]
+    return res
+
+
+def dtw_path(x, y, band=None):
+    # Exact banded DTW keeping the whole cost matrix, and the optimal warping
+    # path as a list of (i, j) found by backtracking from the last cell.
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n, m = len(x), len(y)
+    multivariate = x.ndim > 1
+    lo, hi = band_window(n, m, band)
+
+    # D[i + 1, j + 1] holds the cost of the best path ending at (i, j).
+    D = np.full((n + 1, m + 1), np.inf)
+    D[0, 0] = 0.0
+    for i in range(n):
+        l, h = lo[i], hi[i] + 1
+        cost = local_cost(x[i], y[l:h], multivariate)
+        step = cost + np.minimum(D[i, l:h], D[i, l + 1:h + 1])
+        cumsum = np.cumsum(cost)
+        D[i + 1, l + 1:h + 1] = cumsum + np.minimum.accumulate(step - cumsum)
+
+    path = [(n - 1, m - 1)]
+    i, j = n, m
+    while (i, j) != (1, 1):
+        moves = [(i - 1, j - 1), (i - 1, j), (i, j - 1)]
+        i, j = min(moves, key=lambda move: D[move])
+        path.append((i - 1, j - 1))
+    path.reverse()
+    return float(D[n, m]), path
+
+
+#==============#
+# DTW Backends #
+#==============#
+class FastDTWBackend():
+    name = 'fastdtw'
+
+    def __init__(self, band=None):
+        # fastdtw is not band-limited, so LB_Keogh does not bound it and it
+        # cannot be abandoned early.
+        self.band = None
+
+
+    def distance(self, x, y, max_cost=np.inf):
+        return self.path(x, y)[0]
+
+
+    def distances(self, x, ys, max_costs=None):
+        return [self.distance(x, y) for y in ys]
+
+
+    def path(self, x, y):
+        # Points of multivariate sequences are compared by the Euclidean
+        # distance (fastdtw's default for them is the 1-norm).
+        return fastdtw(x, y, dist=2 if np.ndim(x) > 1 else None)
+
+
+class BandedDTWBackend():
+    name = 'banded'
+
+    def __init__(self, band):
+        self.band = band
+
+
+    def distance(self, x, y, max_cost=np.inf):
+        return dtw_wavefront(x, y, self.band, max_cost)
+
+
+    def distances(self, x, ys, max_costs=None):
+        return list(dtw_batch(x, ys, self.band, None if max_costs is None else np.asarray(max_costs, dtype=np.float64)))
+
+
+    def path(self, x, y):
+        return dtw_path(x, y, self.band)
+
+
+class RowBandedDTWBackend(BandedDTWBackend):
+    name = 'banded_rows'
+
+    def distance(self, x, y, max_cost=np.inf):
+        return dtw_rows(x, y, self.band, max_cost)
+
+
+BACKENDS = {backend.name: backend for backend in (FastDTWBackend, BandedDTWBackend, RowBandedDTWBackend)}
+
+
+def random_walk_pairs(num, length, seed=0):
+    # Derivative-like sequences of tear contours for benchmarking.
+    rng = np.random.default_rng(seed)
+    return [(rng.choice([-1.0, -0.5, 0.0, 0.5, 1.0], length),
+             rng.choice([-1.0, -0.5, 0.0, 0.5, 1.0], int(length * rng.uniform(0.9, 1.1))))
+            for _ in range(num)]
+
+
+def benchmark_backends(band, pairs=None, names=None):
+    # Returns the mean seconds per distance of each backend.
+    pairs = pairs if pairs is not None else random_walk_pairs(3, 1000)
+    names = names if names is not None else list(BACKENDS)
+    timings = {}
+    for name in names:
+        backend = BACKENDS[name](band)
+        begin = time.perf_counter()
+        for x, y in pairs:
+            backend.distance(x, y)
+        timings[name] = (time.perf_counter() - begin) / len(pairs)
+    return timings
+
+
+def get_backend(name, band):
+    if name == 'auto':
+        timings = benchmark_backends(band)
+        name = min(timings, key=timings.get)
+        logger.info('DTW backend timings: {} -> {}'.format(timings, name))
+    return BACKENDS[name](band)
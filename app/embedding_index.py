@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__    = 'Shion Tominaga and Akihiro Miyata'
+__copyright__ = 'Copyright (c) 2018-2021 Miyata Lab.'
+
+# Standard library imports.
+import heapq
+import threading as th
+
+# Related third party imports.
+import numpy as np
+
+
+# Number of points the contour is resampled to, and number of Fourier
+# harmonics kept on each side of the spectrum.
+RESAMPLE_SIZE = 64
+HARMONICS     = 8
+
+# Points per leaf of the KD-tree.
+LEAF_SIZE = 16
+
+# Entries added or removed since the last build are scanned linearly or
+# skipped until there are more than REBUILD_MIN of them and REBUILD_RATIO of
+# the tree.
+REBUILD_MIN   = 64
+REBUILD_RATIO = 0.1
+
+
+def resample(shape_x, shape_y, size=RESAMPLE_SIZE):
+    # Resamples the contour to size points evenly spaced along its length.
+    points = np.column_stack((shape_x, shape_y)).astype(np.float64)
+    lengths = np.concatenate([[0.0], np.cumsum(np.hypot(*np.diff(points, axis=0).T))])
+    if lengths[-1] == 0:
+        return np.repeat(points[:1], size, axis=0)
+    positions = np.linspace(0, lengths[-1], size)
+    return np.column_stack((np.interp(positions, lengths, points[:, 0]),
+                            np.interp(positions, lengths, points[:, 1])))
+
+
+def embed(shape_x, shape_y, size=RESAMPLE_SIZE, harmonics=HARMONICS):
+    # Fixed-length embedding of a contour: the low-frequency Fourier
+    # descriptors of the resampled points. Dropping the DC term removes the
+    # translation and dividing by the RMS radius removes the scale. Phases are
+    # kept, so the Euclidean distance approximates that of the smoothed curves.
+    points = resample(shape_x, shape_y, size)
+    z = points[:, 0] + 1j * points[:, 1]
+    z = z - z.mean()
+    radius = np.sqrt(np.mean(np.abs(z) ** 2))
+    if radius > 0:
+        z = z / radius
+    coefficients = np.fft.fft(z) / size
+    harmonics = min(harmonics, (size - 1) // 2)
+    kept = np.concatenate([coefficients[1:harmonics + 1], coefficients[-harmonics:]])
+    return np.concatenate([kept.real, kept.imag])
+
+
+class KDTree():
+    def __init__(self, keys, points, leaf_size=LEAF_SIZE):
+        self.keys   = list(keys)
+        self.points = np.asarray(points, dtype=np.float64).reshape(len(self.keys), -1) if self.keys else np.empty((0, 0))
+        self.leaf_size = leaf_size
+        # self.index[lo:hi] are the points of a node; each node is
+        # (lo, hi, split dimension, split value, left child, right child) and
+        # leaves have no split dimension (-1).
+        self.index = np.arange(len(self.keys))
+        self.nodes = []
+        self.root  = self.build(0, len(self.keys)) if self.keys else None
+
+
+    def __len__(self):
+        return len(self.keys)
+
+
+    def build(self, lo, hi):
+        node = len(self.nodes)
+        self.nodes.append(None)
+        if hi - lo <= self.leaf_size:
+            self.nodes[node] = (lo, hi, -1, 0.0, -1, -1)
+            return node
+        indices = self.index[lo:hi]
+        dim = int(np.argmax(np.ptp(self.points[indices], axis=0)))
+        mid = (lo + hi) // 2
+        order = np.argpartition(self.points[indices, dim], mid - lo)
+        self.index[lo:hi] = indices[order]
+        split = float(self.points[self.index[mid], dim])
+        left  = self.build(lo, mid)
+        right = self.build(mid, hi)
+        self.nodes[node] = (lo, hi, dim, split, left, right)
+        return node
+
+
+    def query(self, point, k, allowed=None):
+        # Returns the k nearest entries as [(distance, key), ...] in ascending
+        # order. Only the keys in allowed are considered if it is given.
+        point = np.asarray(point, dtype=np.float64)
+        best = []  # Max-heap of (-squared distance, index).
+        if self.root is not None and k > 0:
+            self.search(self.root, point, k, allowed, best)
+        return [(float(np.sqrt(-d)), self.keys[i]) for d, i in sorted(best, reverse=True)]
+
+
+    def search(self, node, point, k, allowed, best):
+        lo, hi, dim, split, left, right = self.nodes[node]
+        if dim < 0:
+            indices = self.index[lo:hi]
+            distances = np.square(self.points[indices] - point).sum(axis=1)
+            for i, d in zip(indices, distances):
+                if allowed is not None and self.keys[i] not in allowed:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-d, i))
+                elif d < -best[0][0]:
+                    heapq.heapreplace(best, (-d, i))
+            return
+        offset = point[dim] - split
+        near, far = (left, right) if offset < 0 else (right, left)
+        self.search(near, point, k, allowed, best)
+        if len(best) < k or offset * offset < -best[0][0]:
+            self.search(far, point, k, allowed, best)
+
+
+class EmbeddingIndex():
+    def __init__(self):
+        # Embeddings by key. The KD-tree covers the entries present at its
+        # last build; later ones are in self.pending and the removed ones in
+        # self.removed.
+        self.vectors = {}
+        self.tree    = KDTree([], [])
+        self.pending = set()
+        self.removed = set()
+        self.lock    = th.Lock()
+
+
+    def __len__(self):
+        return len(self.vectors)
+
+
+    def __contains__(self, key):
+        return key in self.vectors
+
+
+    def add(self, key, vector):
+        with self.lock:
+            self.vectors[key] = np.asarray(vector, dtype=np.float64)
+            self.pending.add(key)
+            self.removed.discard(key)
+            self.rebuild_if_stale()
+
+
+    def remove(self, key):
+        with self.lock:
+            if self.vectors.pop(key, None) is None:
+                return
+            self.pending.discard(key)
+            self.removed.add(key)
+            self.rebuild_if_stale()
+
+
+    def rebuild_if_stale(self):
+        # The caller holds self.lock.
+        if len(self.pending) + len(self.removed) > max(REBUILD_MIN, REBUILD_RATIO * len(self.tree)):
+            self.rebuild()
+
+
+    def rebuild(self):
+        # The caller holds self.lock.
+        keys = list(self.vectors)
+        self.tree = KDTree(keys, [self.vectors[key] for key in keys])
+        self.pending = set()
+        self.removed = set()
+
+
+    def query(self, vector, k, allowed=None):
+        # Returns the k nearest entries as [(distance, key), ...] in ascending
+        # order. Only the keys in allowed are considered if it is given.
+        vector = np.asarray(vector, dtype=np.float64)
+        with self.lock:
+            tree, pending, removed = self.tree, set(self.pending), set(self.removed)
+            pending_vectors = {key: self.vectors[key] for key in pending}
+        # Keys added again since the build are only taken from pending.
+        nearest = [(d, key) for d, key in tree.query(vector, k + len(pending) + len(removed), allowed)
+                   if key not in pending and key not in removed]
+        for key, pending_vector in pending_vectors.items():
+            if allowed is None or key in allowed:
+                nearest.append((float(np.linalg.norm(pending_vector - vector)), key))
+        return heapq.nsmallest(k, nearest, key=lambda entry: entry[0])
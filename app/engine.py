@@ -5,19 +5,151 @@ __author__    = 'Shion Tominaga, Kenro Go and Akihiro Miyata'
 __copyright__ = 'Copyright (c) 2018-2020 Miyata Lab.'
 
 # Standard library imports.
+import heapq
 import logging
+import pathlib
+import random
+import sys
+import threading as th
+import time
+from collections import defaultdict
 
 # Related third party imports.
-from fastdtw import fastdtw
+import numpy as np
+
+# Local application/library specific imports.
+current_dir = pathlib.Path(__file__).resolve().parent
+sys.path.append(str(current_dir))
+import dtw
+import embedding_index
+import geometric_hash
+import scalar_features as sf
+import scoring_pool
+import similarity_cache
 
 
 logger = logging.getLogger(__name__)
 
+# Weights for fs.
+FS_X_WEIGHT = 1
+FS_Y_WEIGHT = 1
+
+# Tolerances of fh and fa.
+FH_THRESHOLD = 0.2
+FA_THRESHOLD = 10.0
+
+# Default weights of the scalar features (see scalar_features.SCALAR_NAMES)
+# in the space prefilter() picks the nearest candidates in: the inverse of the
+# tolerances of fh and fa, and of 100 pixels of width.
+PREFILTER_WEIGHTS = {'fh': 1 / FH_THRESHOLD, 'fa': 1 / FA_THRESHOLD, 'width': 0.01}
+
+# Lower limit of DTW distances when they are turned into similarities.
+MIN_DISTANCE = 1e-9
+
+
+class ScoreMatrix():
+    def __init__(self, query_ids, gallery_ids, scores, digit):
+        # scores[i, j] is the fs similarity of query i to gallery piece j, or
+        # -inf if the pair was filtered out.
+        self.query_ids   = list(query_ids)
+        self.gallery_ids = list(gallery_ids)
+        self.scores      = scores
+        self.digit       = digit
+
+
+    def row_argmax(self):
+        # The best gallery piece of each query (None if all were filtered out).
+        # On equal scores the earlier piece wins, as in MatchingEngine.match().
+        best = np.argmax(self.scores, axis=1) if len(self.gallery_ids) else []
+        return {query_id: self.gallery_ids[j] if np.isfinite(self.scores[i, j]) else None
+                for i, (query_id, j) in enumerate(zip(self.query_ids, best))}
+
+
+    def column_argmax(self):
+        # The best query of each gallery piece. The query pieces are mirrored
+        # when scored, so this approximates matching the other way round.
+        best = np.argmax(self.scores, axis=0) if len(self.query_ids) else []
+        return {gallery_id: self.query_ids[i] if np.isfinite(self.scores[i, j]) else None
+                for j, (gallery_id, i) in enumerate(zip(self.gallery_ids, best))}
+
+
+    def normalized_rows(self):
+        # Each row normalized (range: 0-1) over its scored pairs; the filtered
+        # pairs stay -inf.
+        normalized = np.full(self.scores.shape, -np.inf)
+        for i, row in enumerate(self.scores):
+            valid = np.isfinite(row)
+            if not valid.any():
+                continue
+            denominator = float(row[valid].max() - row[valid].min())
+            normalized[i, valid] = np.round((row[valid] - row[valid].min()) / denominator, self.digit) if denominator != 0 else 0.0
+        return normalized
+
 
 class MatchingEngine():
-    def __init__(self, weight_fs, digit):
+    def __init__(self, weight_fs, digit, cascade=False, band=0.1, workers=0, backend='fastdtw', batch_size=256,
+                 multivariate=False, coarse_factors=(), coarse_top=(), audit_rate=0.0, deadline=None,
+                 retrieval_k=0, hash_top=0, box_tolerances=None, use_fp=False, prefilter_k=0, prefilter_weights=None,
+                 cache_size=0, cache_ttl=None):
         self.weight_fs = weight_fs
         self.digit     = digit
+        self.cascade   = cascade
+        self.band      = band
+        # Whether fs is compared by one DTW over the (x, y) points of the tear
+        # instead of one DTW per coordinate (see shape_channels()).
+        self.multivariate = multivariate
+        # Coarse-to-fine stages: before the full-resolution DTW, only the
+        # coarse_top[i] best candidates on sequences downsampled by
+        # coarse_factors[i] are kept (see coarse_survivors()).
+        self.coarse_factors = list(coarse_factors)
+        self.coarse_top     = list(coarse_top)
+        if len(self.coarse_factors) != len(self.coarse_top):
+            raise ValueError('coarse_factors and coarse_top must have the same length.')
+        # Number of candidates whose Fourier-descriptor embeddings are nearest
+        # to the query's that go on to DTW (0 disables, see retrieve()).
+        self.retrieval_k = retrieval_k
+        self.index = embedding_index.EmbeddingIndex()
+        # Number of candidates with the most votes of the geometric hashing
+        # index that go on to retrieval or DTW (0 disables).
+        self.hash_top   = hash_top
+        self.hash_index = geometric_hash.GeometricHashIndex()
+        # Ratio of the requests checked against an exhaustive full-resolution
+        # ranking when coarse stages or retrieval are used (see audit()).
+        self.audit_rate  = audit_rate
+        self.audit_stats = {'audited': 0, 'missed': 0, 'relevant': 0, 'retrieved': 0}
+        # Number of candidates nearest to the query in the weighted scalar
+        # feature space that go on to retrieval or DTW, in place of the fh
+        # tolerance (0 disables, see prefilter()).
+        self.prefilter_k       = prefilter_k
+        self.prefilter_weights = prefilter_weights or PREFILTER_WEIGHTS
+        self.scalar_index      = embedding_index.EmbeddingIndex()
+        # Tolerances of the extra scalar features in candidate_box(), e.g.
+        # {'width': 50, 'length': 0.1, 'tilt': 0.05}.
+        self.box_tolerances = box_tolerances or {}
+        # Registered candidate IDs by fp (see partition()), and whether the
+        # server filters candidates on fp.
+        self.fp_buckets = defaultdict(set)
+        self.use_fp     = use_fp
+        # Default time budget in seconds of match_anytime().
+        self.deadline = deadline
+        # DTW distance of the derivative sequences (see dtw.BACKENDS).
+        self.backend   = dtw.get_backend(backend, band)
+        # Number of candidates a banded backend scores in lockstep.
+        self.batch_size = batch_size
+        # fs similarities keyed by (query ID, candidate ID, self.version) kept
+        # across requests (see cached_scores()). The version changes with the
+        # settings the similarities depend on.
+        self.cache   = similarity_cache.SimilarityCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self.version = '{}/{}/{}'.format(type(self.backend).__name__, band, multivariate)
+        # Pre-parsed candidate features keyed by candidate ID (see prepare_candidates()).
+        self.gallery   = {}
+        # Cumulative counters of the pruning cascade (see rank_cascade()):
+        # candidates skipped by a lower bound before any DTW, candidates whose
+        # DTW was started but abandoned, and candidates scored exactly.
+        self.prune_stats = {'candidates': 0, 'lb_kim': 0, 'lb_keogh': 0, 'abandoned': 0, 'dtw': 0}
+        self.prune_lock  = th.Lock()
+        # Worker processes scoring shards of the candidates (see rank_parallel()).
+        self.pool = scoring_pool.ScoringPool(workers, self) if workers > 0 else None
 
 
     def normalization(self, data):
@@ -33,19 +165,32 @@ class MatchingEngine():
 
 
     def is_fh_matched(self, input_fh, candidates_fh):
-        fh_threshold = 0.2
-        if abs(input_fh - candidates_fh) < fh_threshold:
+        if abs(input_fh - candidates_fh) < FH_THRESHOLD:
             return True
         return False
 
 
     def is_fa_matched(self, input_fa, candidates_fa):
-        fa_threshold = 10.0
-        if abs(input_fa - candidates_fa) < fa_threshold:
+        if abs(input_fa - candidates_fa) < FA_THRESHOLD:
             return True
         return False
 
 
+    def candidate_box(self, features, use_fh=True, use_fa=False):
+        # Range of each scalar feature (see scalar_features.SCALAR_NAMES) a
+        # candidate can have, for the DB to return only the rows inside. The
+        # extra features are bounded by self.box_tolerances; 0 leaves them
+        # open. The box only narrows what is_candidate() checks again.
+        values = sf.scalar_features(features['shape_x'], features['shape_y'], features['height'], features['angle'])
+        tolerances = dict(self.box_tolerances)
+        if use_fh:
+            tolerances['fh'] = FH_THRESHOLD
+        if use_fa:
+            tolerances['fa'] = FA_THRESHOLD
+        return {name: (values[name] - tolerance, values[name] + tolerance)
+                for name, tolerance in tolerances.items() if tolerance > 0}
+
+
     def is_fp_matched(self, input_fp, candidates_fp):
         for i in range(len(input_fp)):
             if input_fp[i] != candidates_fp[i]: return False
@@ -65,95 +210,821 @@ class MatchingEngine():
 
 
     def derivative(self, arr):
+        arr = np.asarray(arr)
         if len(arr) == 0:
             raise Exception("Incorrect input. Must be an array with more than 1 element.")
-        d_arr = []
-        for i in range(1, len(arr) - 1):
-            d_arr.append(((arr[i] - arr[i - 1]) + ((arr[i + 1] - arr[i - 1]) / 2)) / 2)
-        return d_arr
+        return ((arr[1:-1] - arr[:-2]) + ((arr[2:] - arr[:-2]) / 2)) / 2
 
 
-    def match(self, features, candidates, use_fh=True, use_fa=False, use_fp=False):
-        # Calculates feature similarities.
-        logger.info('use_fh: {}'.format(use_fh))
-        print('Use Fh: {}'.format(use_fh))
-        logger.info('use_fa: {}'.format(use_fa))
-        print('Use Fa: {}'.format(use_fa))
-        logger.info('use_fp: {}'.format(use_fp))
-        print('Use Fp: {}'.format(use_fp))
+    def calibrate(self, arr):
+        return arr - arr[0]
+
+
+    def to_array(self, values, dtype=np.float32):
+        if type(values) is str:
+            return np.array(values.split(','), dtype=dtype)
+        return np.asarray(values, dtype=dtype)
+
+
+    def is_prepared(self, features):
+        return 'shape_x_d' in features
+
+
+    def prepare_features(self, features, mirror=False):
+        # Parses the stored features into float32 arrays and precomputes the
+        # calibrated derivative sequences used by DTW.
+        shape_x = self.to_array(features['shape_x'])
+        shape_y = self.to_array(features['shape_y'])
+        if mirror:
+            # The query piece faces the candidates, so its tear is traced
+            # backwards and flipped vertically.
+            shape_x = shape_x[::-1]
+            shape_y = -shape_y[::-1]
+        prepared = {'shape_x': shape_x,
+                    'shape_y': shape_y,
+                    'height': float(features['height']),
+                    'angle': float(features['angle']),
+                    'position': self.to_array(features['position'], dtype=np.int8),
+                    'shape_x_d': self.derivative(self.calibrate(shape_x)),
+                    'shape_y_d': self.derivative(self.calibrate(shape_y))
+                    }
+        if self.multivariate:
+            prepared['shape_xy_d'] = np.column_stack((prepared['shape_x_d'], prepared['shape_y_d']))
+        if self.retrieval_k > 0:
+            prepared['embedding'] = self.embedding(prepared, mirror)
+        if self.prefilter_k > 0:
+            prepared['scalars'] = self.scalar_vector(shape_x, shape_y, prepared['height'], prepared['angle'])
+        if self.hash_top > 0:
+            prepared['hash_keys'] = geometric_hash.hash_keys(geometric_hash.keypoints(*self.outline(shape_x, shape_y, mirror)))
+        for factor in self.coarse_factors:
+            for _, _, key in self.channel_keys():
+                prepared[self.sequence_key(key, factor)] = dtw.paa(prepared[key], factor)
+        return prepared
+
+
+    def outline(self, shape_x, shape_y, mirror):
+        # The mirrored query tear runs right to left and is a reflection of
+        # the candidate's. Negating x turns it into the query rotated by 180
+        # degrees, which is traced left to right like the candidates. The
+        # embedding and the hash keys are not reflection invariant, so they
+        # are computed on this outline.
+        if mirror:
+            return -shape_x, shape_y
+        return shape_x, shape_y
 
-        ids, fs_similarity = [], []
+
+    def embedding(self, prepared, mirror=False):
+        # mirror tells whether prepared is a query (see outline()).
+        return embedding_index.embed(*self.outline(prepared['shape_x'], prepared['shape_y'], mirror))
+
+
+    def scalar_vector(self, shape_x, shape_y, height, angle):
+        # The scalar features scaled by self.prefilter_weights; the unweighted
+        # ones are 0.
+        values = sf.scalar_features(shape_x, shape_y, height, angle)
+        return np.array([values[name] * self.prefilter_weights.get(name, 0.0) for name in sf.SCALAR_NAMES])
+
+
+    def prepare_query(self, features):
+        return self.prepare_features(features, mirror=True)
+
+
+    def prepare_candidate(self, candidate_features):
+        if self.is_prepared(candidate_features):
+            return candidate_features
+        return self.prepare_features(candidate_features)
+
+
+    def prepare_candidates(self, candidates, cache=False):
+        # Candidate features never change once registered, so the parsed
+        # arrays can be kept in self.gallery and reused by later requests.
+        prepared = {}
         for candidate_id, candidate_features in candidates.items():
-            input_fh = features['height']
-            candidates_fh = float(candidate_features['height']) if type(candidate_features['height']) is str else candidate_features['height']
-            if use_fh and not self.is_fh_matched(input_fh, candidates_fh):
+            if cache and candidate_id in self.gallery:
+                prepared[candidate_id] = self.gallery[candidate_id]
                 continue
+            if cache:
+                prepared[candidate_id] = self.register(candidate_id, candidate_features)
+            else:
+                prepared[candidate_id] = self.prepare_candidate(candidate_features)
+        return prepared
 
-            input_fa = features['angle']
-            candidates_fa = float(candidate_features['angle']) if type(candidate_features['angle']) is str else candidate_features['angle']
-            if use_fa and not self.is_fa_matched(input_fa, candidates_fa):
-                continue
 
-            input_fp = features['position']
-            candidates_fp = list(map(float, candidate_features['position'].split(','))) if type(candidate_features['position']) is str else candidate_features['position']
-            if use_fp and not self.is_fp_matched(input_fp, candidates_fp):
+    def register(self, candidate_id, features):
+        # Keeps the prepared features of a newly registered piece in
+        # self.gallery and its fp bucket, its embedding in self.index and its
+        # hash keys in self.hash_index.
+        prepared = self.prepare_candidate(features)
+        previous = self.gallery.get(candidate_id)
+        if previous is not None:
+            self.fp_buckets[self.fp_key(previous['position'])].discard(candidate_id)
+        self.gallery[candidate_id] = prepared
+        self.fp_buckets[self.fp_key(prepared['position'])].add(candidate_id)
+        if self.retrieval_k > 0:
+            self.index.add(candidate_id, prepared['embedding'])
+        if self.hash_top > 0:
+            self.hash_index.add(candidate_id, prepared['hash_keys'])
+        if self.prefilter_k > 0:
+            self.scalar_index.add(candidate_id, prepared['scalars'])
+        return prepared
+
+
+    def forget(self, candidate_ids):
+        # Drops the registered pieces of candidate_ids, e.g. when their
+        # session is deleted.
+        for candidate_id in candidate_ids:
+            prepared = self.gallery.pop(candidate_id, None)
+            if prepared is None:
                 continue
+            self.fp_buckets[self.fp_key(prepared['position'])].discard(candidate_id)
+            self.index.remove(candidate_id)
+            self.hash_index.remove(candidate_id)
+            self.scalar_index.remove(candidate_id)
 
-            ids.append(candidate_id)
-            input_fs_x      = self.reverse_list(features['shape_x'])
-            input_fs_y      = self.multiply_minus(self.reverse_list(features['shape_y']))
-            candidates_fs_x = list(map(float, candidate_features['shape_x'].split(','))) if type(candidate_features['shape_x']) is str else candidate_features['shape_x']
-            candidates_fs_y = list(map(float, candidate_features['shape_y'].split(','))) if type(candidate_features['shape_y']) is str else candidate_features['shape_y']
 
-            # Calibration.
-            input_fs_x      = [i - input_fs_x[0] for i in input_fs_x]
-            input_fs_y      = [i - input_fs_y[0] for i in input_fs_y]
-            candidates_fs_x = [i - candidates_fs_x[0] for i in candidates_fs_x]
-            candidates_fs_y = [i - candidates_fs_y[0] for i in candidates_fs_y]
+    def fp_key(self, position):
+        return tuple(int(value) for value in self.to_array(position, dtype=np.int8))
 
-            # Derivative DTW.
-            input_fs_x_d      = self.derivative(input_fs_x)
-            input_fs_y_d      = self.derivative(input_fs_y)
-            candidates_fs_x_d = self.derivative(candidates_fs_x)
-            candidates_fs_y_d = self.derivative(candidates_fs_y)
-            # fs_x_similarity = 1.0 / fastdtw(input_fs_x, candidates_fs_x)[0]
-            # fs_y_similarity = 1.0 / fastdtw(input_fs_y, candidates_fs_y)[0]
-            fs_x_similarity = 1.0 / fastdtw(input_fs_x_d, candidates_fs_x_d)[0]
-            fs_y_similarity = 1.0 / fastdtw(input_fs_y_d, candidates_fs_y_d)[0]
-
-            # Weights for fs.
-            FS_X_WEIGHT = 1
-            FS_Y_WEIGHT = 1
-
-            fs_similarity.append(fs_x_similarity * FS_X_WEIGHT + fs_y_similarity * FS_Y_WEIGHT)
-            print('candidate ID    =', candidate_id)
-            print('fs_x_similarity =', fs_x_similarity * FS_X_WEIGHT)
-            print('fs_y_similarity =', fs_y_similarity * FS_Y_WEIGHT)
-            print('')
-
-        logger.info('shape_scores = {}'.format(fs_similarity))
-
-        if fs_similarity == []:
+
+    def partition(self, query, candidates, use_fp):
+        # With use_fp, keeps the candidates whose fp equals the query's (as
+        # is_fp_matched() does). Registered candidates are looked up in their
+        # bucket instead of being compared one by one.
+        if not use_fp:
+            return candidates
+        bucket = self.fp_buckets.get(self.fp_key(query['position']), set())
+        return {candidate_id: candidate_features for candidate_id, candidate_features in candidates.items()
+                if candidate_id in bucket or (candidate_id not in self.gallery
+                                              and self.is_fp_matched(query['position'], self.to_array(candidate_features['position'])))}
+
+
+    def is_candidate(self, query, candidate_features, use_fh, use_fa, use_fp):
+        if use_fh and not self.is_fh_matched(query['height'], float(candidate_features['height'])):
+            return False
+        if use_fa and not self.is_fa_matched(query['angle'], float(candidate_features['angle'])):
+            return False
+        if use_fp and not self.is_fp_matched(query['position'], self.to_array(candidate_features['position'])):
+            return False
+        return True
+
+
+    def similarity(self, weight, distance):
+        return weight / max(distance, MIN_DISTANCE)
+
+
+    def channel_keys(self):
+        # (name, weight, feature key) for each DTW of fs. The multivariate DTW
+        # takes both weights, which keeps its scores on the same scale.
+        if self.multivariate:
+            return [('fs_xy', FS_X_WEIGHT + FS_Y_WEIGHT, 'shape_xy_d')]
+        return [('fs_x', FS_X_WEIGHT, 'shape_x_d'),
+                ('fs_y', FS_Y_WEIGHT, 'shape_y_d')]
+
+
+    def sequence_key(self, key, factor=1):
+        # Feature key of a derivative sequence downsampled by factor.
+        return key if factor <= 1 else '{}_paa{}'.format(key, factor)
+
+
+    def channel_similarities(self, query, batch, factor=1):
+        # Similarities of each channel for the (order, candidate_id, prepared
+        # features) of batch, as one tuple per candidate.
+        similarities = []
+        for _, weight, key in self.channel_keys():
+            key = self.sequence_key(key, factor)
+            distances = self.backend.distances(query[key], [candidate[key] for _, _, candidate in batch])
+            similarities.append([self.similarity(weight, distance) for distance in distances])
+        return list(zip(*similarities))
+
+
+    def shape_channels(self, query, candidate):
+        # (weight, query sequence, candidate sequence) for each DTW of fs.
+        return [(weight, query[key], candidate[key]) for _, weight, key in self.channel_keys()]
+
+
+    def warping_path(self, features, candidate_features):
+        # Returns the DTW distance and warping path [(query index, candidate
+        # index), ...] of each channel, indexed on the mirrored derivative
+        # sequences of the query.
+        query     = self.prepare_query(features)
+        candidate = self.prepare_candidate(candidate_features)
+        return {name: self.backend.path(query[key], candidate[key]) for name, _, key in self.channel_keys()}
+
+
+    def pruning_rate(self):
+        # Ratio of the candidates skipped without running any DTW. Abandoned
+        # DTWs have already paid for part of the work and are not counted.
+        with self.prune_lock:
+            pruned = self.prune_stats['lb_kim'] + self.prune_stats['lb_keogh']
+            return pruned / self.prune_stats['candidates'] if self.prune_stats['candidates'] else 0.0
+
+
+    def abandon_rate(self):
+        with self.prune_lock:
+            return self.prune_stats['abandoned'] / self.prune_stats['candidates'] if self.prune_stats['candidates'] else 0.0
+
+
+    def miss_rate(self):
+        # How often the audited rankings missed the exhaustive winner.
+        with self.prune_lock:
+            return self.audit_stats['missed'] / self.audit_stats['audited'] if self.audit_stats['audited'] else 0.0
+
+
+    def retrieval_recall(self):
+        # Ratio of the exhaustive top k of the audited requests that were
+        # retrieved (recall@retrieval_k).
+        with self.prune_lock:
+            return self.audit_stats['retrieved'] / self.audit_stats['relevant'] if self.audit_stats['relevant'] else 0.0
+
+
+    def push_topk(self, top, k, score, order, candidate_id):
+        # top is a min-heap of the k best (score, -order, candidate_id). On equal
+        # scores the earlier candidate is kept.
+        if len(top) < k:
+            heapq.heappush(top, (score, -order, candidate_id))
+        elif (score, -order) > top[0][:2]:
+            heapq.heapreplace(top, (score, -order, candidate_id))
+
+
+    def kth_score(self, top, k):
+        return top[0][0] if len(top) >= k else -np.inf
+
+
+    def normalize_score(self, score, min_score, max_score):
+        denominator = float(max_score - min_score)
+        if denominator != 0:
+            return round(float(score - min_score) / denominator, self.digit)
+        return 0.0
+
+
+    def match(self, features, candidates, use_fh=True, use_fa=False, use_fp=False, query_id=None):
+        # Calculates feature similarities.
+        logger.info('use_fh: {}'.format(use_fh))
+        print('Use Fh: {}'.format(use_fh))
+        logger.info('use_fa: {}'.format(use_fa))
+        print('Use Fa: {}'.format(use_fa))
+        logger.info('use_fp: {}'.format(use_fp))
+        print('Use Fp: {}'.format(use_fp))
+
+        ranking = self.match_topk(features, candidates, 1, use_fh, use_fa, use_fp, query_id)
+        if ranking == []:
             max_id    = None
             max_score = None
             print('[WARNING] No match was found.')
         else:
-            # Normalizes score similarities (range: 0-1).
-            self.normalization(fs_similarity)
-            logger.info('shape_norm_scores = {}'.format(fs_similarity))
-
-            # Finds the ID of which score is the highest.
-            max_id    = ids[0]
-            max_score = 0.0
-            for i in range(len(ids)):
-                score = self.weight_fs * fs_similarity[i]
-                print('ID:', ids[i])
-                print('Score =', score)
-                if max_score < score:
-                    max_id    = ids[i]
-                    max_score = score
+            max_id    = ranking[0][0]
+            max_score = self.weight_fs * ranking[0][2]
+
         print('')
         logger.info('max_id = {}, max_score = {}'.format(max_id, max_score))
         print('MAX ID = {}, MAX Score = {}'.format(max_id, max_score))
 
         return max_id
+
+
+    def match_topk(self, features, candidates, k, use_fh=True, use_fa=False, use_fp=False, query_id=None):
+        # Returns the k best candidates as (candidate_id, raw_score, normalized_score)
+        # in descending order. Scores are normalized (range: 0-1) over all the
+        # scored candidates without keeping their scores. With query_id, the
+        # similarities cached for it are reused and only the other candidates
+        # are ranked.
+        query = self.prepare_query(features)
+        # The prefilter takes the place of the fh tolerance; the audit still
+        # compares with the ranking under the tolerance.
+        filter_fh = use_fh and self.prefilter_k <= 0
+        # partition() applies fp, so the later stages do not compare it again.
+        candidates = self.partition(query, candidates, use_fp)
+        use_fp     = False
+        retrieved = self.prefilter(query, candidates, k, use_fa, use_fp)
+        retrieved = self.retrieve(query, retrieved, k, filter_fh, use_fa, use_fp)
+        cached    = self.cached_scores(query_id, query, retrieved, filter_fh, use_fa, use_fp)
+        remaining = {candidate_id: candidate_features for candidate_id, candidate_features in retrieved.items()
+                     if candidate_id not in cached}
+        scored    = {} if self.cache is not None and query_id is not None else None
+        if self.pool is not None:
+            top, min_score, max_score = self.rank_parallel(query, remaining, k, filter_fh, use_fa, use_fp, scored)
+        else:
+            top, min_score, max_score = self.rank(query, remaining, k, filter_fh, use_fa, use_fp,
+                                                  self.cached_floor(cached, k), scored)
+        if cached:
+            top, min_score, max_score = self.merge_cached(top, min_score, max_score, cached, retrieved, k)
+        self.store_scores(query_id, scored)
+
+        ranking = [(candidate_id, float(score), self.normalize_score(score, min_score, max_score))
+                   for score, _, candidate_id in sorted(top, reverse=True)]
+        logger.info('ranking = {}'.format(ranking))
+        if (self.coarse_factors or self.retrieval_k > 0 or self.hash_top > 0 or self.prefilter_k > 0) and random.random() < self.audit_rate:
+            self.audit(query, candidates, retrieved, ranking, k, use_fh, use_fa, use_fp)
+        return ranking
+
+
+    def cache_key(self, query_id, candidate_id):
+        return (query_id, candidate_id, self.version)
+
+
+    def cached_scores(self, query_id, query, candidates, use_fh, use_fa, use_fp):
+        # The cached similarities of query_id to the candidates passing the
+        # filters, by candidate ID.
+        if self.cache is None or query_id is None:
+            return {}
+        found = self.cache.get_many([self.cache_key(query_id, candidate_id) for candidate_id in candidates])
+        cached = {key[1]: score for key, score in found.items()
+                  if self.is_candidate(query, candidates[key[1]], use_fh, use_fa, use_fp)}
+        if cached:
+            logger.info('similarity cache: {} of {} candidates (hit rate = {:.3f})'.format(
+                len(cached), len(candidates), self.cache.hit_rate()))
+        return cached
+
+
+    def store_scores(self, query_id, scored):
+        if scored:
+            self.cache.put_many((self.cache_key(query_id, candidate_id), score) for candidate_id, score in scored.items())
+
+
+    def cached_floor(self, cached, k):
+        # The k-th best cached similarity; a candidate that cannot beat it
+        # cannot enter the top k either.
+        best = heapq.nlargest(k, cached.values())
+        return best[-1] if len(best) >= k else -np.inf
+
+
+    def merge_cached(self, top, min_score, max_score, cached, candidates, k):
+        # Merges the cached similarities into the top k of the other
+        # candidates. Ties are broken by the order of candidates.
+        order  = {candidate_id: i for i, candidate_id in enumerate(candidates)}
+        merged = []
+        for score, _, candidate_id in top:
+            self.push_topk(merged, k, score, order[candidate_id], candidate_id)
+        for candidate_id, score in cached.items():
+            self.push_topk(merged, k, score, order[candidate_id], candidate_id)
+        return merged, min(min_score, min(cached.values())), max(max_score, max(cached.values()))
+
+
+    def prefilter(self, query, candidates, k, use_fa, use_fp):
+        # Keeps the prefilter_k (at least k) candidates passing the fa and fp
+        # filters whose scalar features are nearest to the query's, so that
+        # the later stages get a bounded number of candidates whatever the
+        # density of fh. Registered candidates are looked up in the KD-tree
+        # and the others are compared directly. The candidates keep their
+        # original order.
+        if self.prefilter_k <= 0:
+            return candidates
+        size = max(self.prefilter_k, k)
+        filtered = [candidate_id for candidate_id, candidate_features in candidates.items()
+                    if self.is_candidate(query, candidate_features, False, use_fa, use_fp)]
+        if len(filtered) > size:
+            indexed = {candidate_id for candidate_id in filtered if candidate_id in self.scalar_index}
+            nearest = self.scalar_index.query(query['scalars'], size, allowed=indexed) if indexed else []
+            for candidate_id in filtered:
+                if candidate_id not in indexed:
+                    scalars = self.prepare_candidate(candidates[candidate_id])['scalars']
+                    nearest.append((float(np.linalg.norm(scalars - query['scalars'])), candidate_id))
+            kept = {candidate_id for _, candidate_id in heapq.nsmallest(size, nearest, key=lambda entry: entry[0])}
+            logger.info('prefilter: {} of {} candidates'.format(len(kept), len(filtered)))
+            filtered = [candidate_id for candidate_id in filtered if candidate_id in kept]
+        return {candidate_id: candidates[candidate_id] for candidate_id in filtered}
+
+
+    def retrieve(self, query, candidates, k, use_fh, use_fa, use_fp):
+        # Narrows the candidates passing the filters down to the hash_top (at
+        # least k) of the most geometric-hashing votes, then to the
+        # retrieval_k (at least k) of the nearest embeddings. Registered
+        # candidates are looked up in the indexes and the others are compared
+        # directly. The candidates keep their original order.
+        if self.hash_top <= 0 and self.retrieval_k <= 0:
+            return candidates
+        filtered = [candidate_id for candidate_id, candidate_features in candidates.items()
+                    if self.is_candidate(query, candidate_features, use_fh, use_fa, use_fp)]
+        count = len(filtered)
+        if self.hash_top > 0 and len(filtered) > max(self.hash_top, k):
+            filtered = self.retrieve_by_hash(query, candidates, filtered, max(self.hash_top, k))
+        if self.retrieval_k > 0 and len(filtered) > max(self.retrieval_k, k):
+            filtered = self.retrieve_by_embedding(query, candidates, filtered, max(self.retrieval_k, k))
+        logger.info('retrieval: {} of {} candidates'.format(len(filtered), count))
+        return {candidate_id: candidates[candidate_id] for candidate_id in filtered}
+
+
+    def retrieve_by_hash(self, query, candidates, filtered, size):
+        # Candidates missing from the index get the votes they would have if
+        # they were added to it.
+        indexed = {candidate_id for candidate_id in filtered if candidate_id in self.hash_index}
+        votes = self.hash_index.vote(query['hash_keys'], allowed=indexed) if indexed else {}
+        if len(indexed) < len(filtered):
+            counts = self.hash_index.meet_counts(query['hash_keys'])
+            for candidate_id in filtered:
+                if candidate_id not in indexed:
+                    votes[candidate_id] = geometric_hash.count_votes(
+                        query['hash_keys'], self.prepare_candidate(candidates[candidate_id])['hash_keys'], counts, len(self.hash_index))
+        # On equal votes the earlier candidate is kept.
+        kept = set(heapq.nlargest(size, filtered, key=lambda candidate_id: votes.get(candidate_id, 0)))
+        return [candidate_id for candidate_id in filtered if candidate_id in kept]
+
+
+    def retrieve_by_embedding(self, query, candidates, filtered, size):
+        indexed = {candidate_id for candidate_id in filtered if candidate_id in self.index}
+        nearest = self.index.query(query['embedding'], size, allowed=indexed) if indexed else []
+        for candidate_id in filtered:
+            if candidate_id not in indexed:
+                embedding = self.prepare_candidate(candidates[candidate_id])['embedding']
+                nearest.append((float(np.linalg.norm(embedding - query['embedding'])), candidate_id))
+        kept = {candidate_id for _, candidate_id in heapq.nsmallest(size, nearest, key=lambda entry: entry[0])}
+        return [candidate_id for candidate_id in filtered if candidate_id in kept]
+
+
+    def match_anytime(self, features, candidates, k, deadline=None, use_fh=True, use_fa=False, use_fp=False, query_id=None):
+        # Like match_topk(), but answers within deadline seconds (self.deadline
+        # by default). Candidates are visited in order of the closeness of fh
+        # to the query, and the scan stops once no remaining candidate can
+        # enter the top k according to its LB_Kim bound. Returns the ranking
+        # and whether it is exact; a budget-limited ranking only covers the
+        # candidates scored in time. The scan runs in the calling thread and
+        # starts from the similarities cached for query_id.
+        begin    = time.monotonic()
+        deadline = deadline if deadline is not None else self.deadline
+        query    = self.prepare_query(features)
+        stats    = dict.fromkeys(self.prune_stats, 0)
+        # The prefilter takes the place of the fh tolerance.
+        use_fh   = use_fh and self.prefilter_k <= 0
+        # partition() applies fp, so the later stages do not compare it again.
+        candidates = self.partition(query, candidates, use_fp)
+        use_fp     = False
+        candidates = self.prefilter(query, candidates, k, use_fa, use_fp)
+        candidates = self.retrieve(query, candidates, k, use_fh, use_fa, use_fp)
+        cached     = self.cached_scores(query_id, query, candidates, use_fh, use_fa, use_fp)
+        scored     = {} if self.cache is not None and query_id is not None else None
+
+        top = []
+        min_score, max_score = np.inf, -np.inf
+        visits = []
+        for order, (candidate_id, candidate_features) in enumerate(candidates.items()):
+            if candidate_id in cached:
+                min_score = min(min_score, cached[candidate_id])
+                max_score = max(max_score, cached[candidate_id])
+                self.push_topk(top, k, cached[candidate_id], order, candidate_id)
+                continue
+            if not self.is_candidate(query, candidate_features, use_fh, use_fa, use_fp):
+                continue
+            candidate = self.prepare_candidate(candidate_features)
+            channels  = self.shape_channels(query, candidate)
+            distances = self.lb_kim_distances(channels)
+            bound     = self.upper_bound(channels, distances)
+            visits.append((abs(candidate['height'] - query['height']), order, candidate_id, channels, distances, bound))
+        visits.sort(key=lambda visit: visit[:2])
+        stats['candidates'] = len(visits)
+        # remaining[i] is the highest upper bound among visits[i:].
+        remaining = np.maximum.accumulate([visit[5] for visit in visits][::-1])[::-1]
+
+        exact = True
+        for i, (_, order, candidate_id, channels, distances, bound) in enumerate(visits):
+            if remaining[i] < self.kth_score(top, k):
+                stats['lb_kim'] += len(visits) - i
+                break
+            # At least one candidate is scored so that there is an answer.
+            if deadline is not None and top and time.monotonic() - begin > deadline:
+                exact = False
+                break
+            if bound < self.kth_score(top, k):
+                stats['lb_kim'] += 1
+                continue
+            level = 'lb_kim'
+            if self.backend.band is not None:
+                distances = self.lb_keogh_distances(channels, distances)
+                level = 'lb_keogh'
+                if self.upper_bound(channels, distances) < self.kth_score(top, k):
+                    stats['lb_keogh'] += 1
+                    continue
+
+            score, outcome = self.exact_score(channels, distances, self.kth_score(top, k))
+            if score is None:
+                stats[level if outcome == 'lb' else 'abandoned'] += 1
+                continue
+            stats['dtw'] += 1
+            min_score = min(min_score, score)
+            max_score = max(max_score, score)
+            self.push_topk(top, k, score, order, candidate_id)
+            if scored is not None:
+                scored[candidate_id] = score
+
+        with self.prune_lock:
+            for key, value in stats.items():
+                self.prune_stats[key] += value
+        self.store_scores(query_id, scored)
+        ranking = [(candidate_id, float(score), self.normalize_score(score, min_score, max_score))
+                   for score, _, candidate_id in sorted(top, reverse=True)]
+        logger.info('anytime ranking = {}, exact = {}, elapsed = {:.3f}s, {}'.format(
+            ranking, exact, time.monotonic() - begin, stats))
+        print('Scored {}/{} candidates ({})'.format(stats['dtw'], stats['candidates'], 'exact' if exact else 'budget-limited'))
+        return ranking, exact
+
+
+    def match_many(self, queries, gallery, use_fh=True, use_fa=False, use_fp=False):
+        # Scores every query against every gallery piece at once and returns
+        # a ScoreMatrix. Both are dicts of features keyed by ID. The rows are
+        # sharded over the worker processes if there are any.
+        queries = {query_id: self.prepare_query(features) for query_id, features in queries.items()}
+        gallery = {gallery_id: self.prepare_candidate(features) for gallery_id, features in gallery.items()}
+        if self.pool is not None:
+            scores = self.pool.score_rows(queries, gallery, use_fh, use_fa, use_fp)
+        else:
+            scores = self.score_rows(list(queries.values()), gallery, use_fh, use_fa, use_fp)
+        logger.info('match_many: {}x{} pairs scored'.format(len(queries), len(gallery)))
+        return ScoreMatrix(queries, gallery, scores, self.digit)
+
+
+    def score_rows(self, queries, candidates, use_fh, use_fa, use_fp):
+        # Full-resolution scores of the prepared queries against the prepared
+        # candidates, as an array with -inf for the filtered pairs.
+        scores = np.full((len(queries), len(candidates)), -np.inf)
+        for i, query in enumerate(queries):
+            for batch in self.batches(query, candidates, use_fh, use_fa, use_fp):
+                for (order, _, _), channel_similarities in zip(batch, self.channel_similarities(query, batch)):
+                    scores[i, order] = sum(channel_similarities)
+        return scores
+
+
+    def audit(self, query, candidates, retrieved, ranking, k, use_fh, use_fa, use_fp):
+        # Ranks all the candidates exhaustively at full resolution and counts
+        # whether the ranking found its winner and how many of its top k were
+        # retrieved.
+        top = []
+        for batch in self.batches(query, candidates, use_fh, use_fa, use_fp):
+            for (order, candidate_id, _), channel_similarities in zip(batch, self.channel_similarities(query, batch)):
+                self.push_topk(top, k, sum(channel_similarities), order, candidate_id)
+        exhaustive = [candidate_id for _, _, candidate_id in sorted(top, reverse=True)]
+        missed = exhaustive != [] and (ranking == [] or ranking[0][0] != exhaustive[0])
+        with self.prune_lock:
+            self.audit_stats['audited'] += 1
+            self.audit_stats['missed'] += missed
+            self.audit_stats['relevant'] += len(exhaustive)
+            self.audit_stats['retrieved'] += sum(candidate_id in retrieved for candidate_id in exhaustive)
+        logger.info('audit: winner = {}, missed = {} (miss rate = {:.3f}, recall = {:.3f} over {} audits)'.format(
+            exhaustive[:1], missed, self.miss_rate(), self.retrieval_recall(), self.audit_stats['audited']))
+
+
+    def recall_at_k(self, queries, gallery, ks, use_fh=True, use_fa=False, use_fp=False):
+        # Offline tuning of retrieval_k: for each k of ks, the ratio of the
+        # queries whose exhaustive winner is among their k nearest embeddings.
+        scores  = self.match_many(queries, gallery, use_fh, use_fa, use_fp)
+        winners = scores.row_argmax()
+        gallery_embeddings = np.array([self.embedding(self.prepare_candidate(features)) for features in gallery.values()])
+        ranks = []
+        for i, (query_id, features) in enumerate(queries.items()):
+            if winners[query_id] is None:
+                continue
+            distances = np.linalg.norm(gallery_embeddings - self.embedding(self.prepare_query(features), mirror=True), axis=1)
+            distances[~np.isfinite(scores.scores[i])] = np.inf
+            ranks.append(int((distances < distances[scores.gallery_ids.index(winners[query_id])]).sum()))
+        ranks = np.array(ranks)
+        return {k: float((ranks < k).mean()) if len(ranks) else 0.0 for k in ks}
+
+
+    def rank(self, query, candidates, k, use_fh, use_fa, use_fp, floor=-np.inf, scored=None):
+        # floor is a similarity the top k is known to reach (see
+        # cached_floor()). The exact similarities computed are added to scored
+        # if it is given.
+        if self.coarse_factors:
+            candidates = self.coarse_survivors(query, candidates, k, use_fh, use_fa, use_fp)
+        if self.cascade:
+            return self.rank_cascade(query, candidates, k, use_fh, use_fa, use_fp, floor, scored)
+        return self.rank_exhaustive(query, candidates, k, use_fh, use_fa, use_fp, scored)
+
+
+    def rank_parallel(self, query, candidates, k, use_fh, use_fa, use_fp, scored=None):
+        # Scores shards of the candidates in the worker processes and merges
+        # their top k. fastdtw is pure Python, so threads would not help here.
+        candidates = {candidate_id: self.prepare_candidate(candidate_features)
+                      for candidate_id, candidate_features in candidates.items()
+                      if self.is_candidate(query, candidate_features, use_fh, use_fa, use_fp)}
+        order = {candidate_id: i for i, candidate_id in enumerate(candidates)}
+
+        top = []
+        min_score, max_score = np.inf, -np.inf
+        for shard_top, shard_min, shard_max, stats in self.pool.rank(query, candidates, k, use_fh, use_fa, use_fp):
+            min_score = min(min_score, shard_min)
+            max_score = max(max_score, shard_max)
+            for score, _, candidate_id in shard_top:
+                self.push_topk(top, k, score, order[candidate_id], candidate_id)
+                # Only the top k of each shard come back from the workers.
+                if scored is not None:
+                    scored[candidate_id] = score
+            with self.prune_lock:
+                for key, value in stats.items():
+                    self.prune_stats[key] += value
+        return top, min_score, max_score
+
+
+    def coarse_survivors(self, query, candidates, k, use_fh, use_fa, use_fp):
+        # Keeps, stage by stage, the coarse_top[i] (at least k) candidates of
+        # the highest similarity on the downsampled sequences. The survivors
+        # keep their original order so that ties are broken as before.
+        survivors = {}
+        for batch in self.batches(query, candidates, use_fh, use_fa, use_fp):
+            survivors.update((candidate_id, candidate) for _, candidate_id, candidate in batch)
+        counts = [len(survivors)]
+        for factor, top_n in zip(self.coarse_factors, self.coarse_top):
+            top_n = max(top_n, k)
+            if len(survivors) <= top_n:
+                break
+            scores = {}
+            items  = [(order, candidate_id, candidate) for order, (candidate_id, candidate) in enumerate(survivors.items())]
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                for (_, candidate_id, _), channel_similarities in zip(batch, self.channel_similarities(query, batch, factor)):
+                    scores[candidate_id] = sum(channel_similarities)
+            kept = set(heapq.nlargest(top_n, scores, key=scores.get))
+            survivors = {candidate_id: candidate for candidate_id, candidate in survivors.items() if candidate_id in kept}
+            counts.append(len(survivors))
+        logger.info('coarse stages (factors = {}): {} candidates'.format(self.coarse_factors, ' -> '.join(map(str, counts))))
+        return survivors
+
+
+    def batches(self, query, candidates, use_fh, use_fa, use_fp):
+        # Yields the candidates passing the filters as lists of
+        # (order, candidate_id, prepared features) of up to batch_size.
+        batch = []
+        for order, (candidate_id, candidate_features) in enumerate(candidates.items()):
+            if not self.is_candidate(query, candidate_features, use_fh, use_fa, use_fp):
+                continue
+            batch.append((order, candidate_id, self.prepare_candidate(candidate_features)))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+    def rank_exhaustive(self, query, candidates, k, use_fh, use_fa, use_fp, scored=None):
+        # Banded backends score each batch of candidates in lockstep.
+        channel_keys = self.channel_keys()
+        top = []
+        min_score, max_score = np.inf, -np.inf
+        for batch in self.batches(query, candidates, use_fh, use_fa, use_fp):
+            # Derivative DTW.
+            for (order, candidate_id, _), channel_similarities in zip(batch, self.channel_similarities(query, batch)):
+                score = sum(channel_similarities)
+                min_score = min(min_score, score)
+                max_score = max(max_score, score)
+                self.push_topk(top, k, score, order, candidate_id)
+                if scored is not None:
+                    scored[candidate_id] = score
+                print('candidate ID    =', candidate_id)
+                for (name, _, _), channel_similarity in zip(channel_keys, channel_similarities):
+                    print('{}_similarity ='.format(name), channel_similarity)
+                print('')
+        return top, min_score, max_score
+
+
+    def lb_kim_distances(self, channels):
+        return [dtw.lb_kim(x, y) for _, x, y in channels]
+
+
+    def lb_keogh_distances(self, channels, distances):
+        # Tightens the lower bounds in distances with LB_Keogh.
+        tightened = []
+        for (_, x, y), distance in zip(channels, distances):
+            lower, upper = dtw.envelope(y, len(x), self.backend.band)
+            tightened.append(max(distance, dtw.lb_keogh(x, lower, upper)))
+        return tightened
+
+
+    def upper_bound(self, channels, distances):
+        # Similarity a candidate can reach given lower bounds of its channel
+        # distances. A single bound of 0 makes it unbounded.
+        return sum(self.similarity(w, d) for (w, _, _), d in zip(channels, distances))
+
+
+    def max_cost(self, weight, rest, best):
+        # Distance below which a channel must stay for the candidate to beat
+        # best, when the other channels reach at most rest.
+        return weight / (best - rest) if best > rest else np.inf
+
+
+    def exact_score(self, channels, distances, best):
+        # Runs the DTW of each channel in turn. Each channel is checked in
+        # distance space against what the other channels are known to reach
+        # (their bounds, or their exact similarity once computed): it is
+        # skipped if its lower bound already exceeds the distance it needs,
+        # and otherwise abandoned beyond it. distances holds lower bounds of
+        # the channel distances and is updated in place. Returns the score and
+        # 'dtw', or None and 'lb' (no DTW was run) or 'abandoned'.
+        similarities = [self.similarity(w, d) for (w, _, _), d in zip(channels, distances)]
+        for i, (w, x, y) in enumerate(channels):
+            rest = sum(similarities[j] for j in range(len(channels)) if j != i)
+            max_cost = self.max_cost(w, rest, best)
+            if distances[i] > max_cost:
+                return None, 'lb' if i == 0 else 'abandoned'
+            distances[i] = self.backend.distance(x, y, max_cost)
+            similarities[i] = self.similarity(w, distances[i])
+            # A fastdtw distance is always complete, so only the channels
+            # left out count as abandoned.
+            if distances[i] > max_cost and (i < len(channels) - 1 or not np.isfinite(distances[i])):
+                return None, 'abandoned'
+        return sum(similarities), 'dtw'
+
+
+    def rank_cascade(self, query, candidates, k, use_fh, use_fa, use_fp, floor=-np.inf, scored=None):
+        # Finds the k candidates of the highest fs similarity. Candidates are
+        # visited by descending LB_Kim upper bound in batches of batch_size and
+        # skipped when their bounds (LB_Kim, then LB_Keogh) show they cannot
+        # enter the top k. The survivors go through score_survivors(). LB_Keogh
+        # and abandoning need a banded backend; with fastdtw only LB_Kim and
+        # the per-channel checks apply. Only the candidates scored exactly take
+        # part in the normalization.
+        # The calibrated derivative sequences start at 0 and mostly stay within
+        # a band-wide envelope, so their bounds are often 0 and the cascade
+        # then relies on abandoning. That saves less than the overhead of the
+        # bounds, and the cascade is about as fast as rank_exhaustive() with a
+        # banded backend. It only pays off when the bounds are informative.
+        stats = dict.fromkeys(self.prune_stats, 0)
+
+        entries = []
+        for order, (candidate_id, candidate_features) in enumerate(candidates.items()):
+            if not self.is_candidate(query, candidate_features, use_fh, use_fa, use_fp):
+                continue
+            candidate = self.prepare_candidate(candidate_features)
+            channels  = self.shape_channels(query, candidate)
+            distances = self.lb_kim_distances(channels)
+            entries.append((self.upper_bound(channels, distances), order, candidate_id, channels, distances))
+        # Unbounded candidates (one LB_Kim of 0) are common with derivative
+        # sequences; among them the closest ends go first.
+        entries.sort(key=lambda entry: (-entry[0], sum(entry[4]), entry[1]))
+        stats['candidates'] = len(entries)
+
+        top = []
+        min_score, max_score = np.inf, -np.inf
+        for start in range(0, len(entries), self.batch_size):
+            best = max(self.kth_score(top, k), floor)
+            if entries[start][0] < best:
+                # Neither can the following ones.
+                stats['lb_kim'] += len(entries) - start
+                break
+            survivors = []
+            for bound, order, candidate_id, channels, distances in entries[start:start + self.batch_size]:
+                if bound < best:
+                    stats['lb_kim'] += 1
+                    continue
+                if self.backend.band is not None:
+                    distances = self.lb_keogh_distances(channels, distances)
+                    if self.upper_bound(channels, distances) < best:
+                        stats['lb_keogh'] += 1
+                        continue
+                survivors.append((order, candidate_id, channels, distances))
+
+            for order, candidate_id, score in self.score_survivors(survivors, best, stats):
+                stats['dtw'] += 1
+                if scored is not None:
+                    scored[candidate_id] = score
+                logger.debug('candidate ID = {}, fs_similarity = {}'.format(candidate_id, score))
+                min_score = min(min_score, score)
+                max_score = max(max_score, score)
+                self.push_topk(top, k, score, order, candidate_id)
+
+        with self.prune_lock:
+            for key, value in stats.items():
+                self.prune_stats[key] += value
+        pruned = stats['lb_kim'] + stats['lb_keogh']
+        logger.info('pruning: {} (rate = {:.3f}, total rate = {:.3f}, total abandon rate = {:.3f})'.format(
+            stats, pruned / stats['candidates'] if stats['candidates'] else 0.0, self.pruning_rate(), self.abandon_rate()))
+        print('Pruned {}/{} candidates (LB_Kim: {}, LB_Keogh: {}), abandoned {} DTWs'.format(
+            pruned, stats['candidates'], stats['lb_kim'], stats['lb_keogh'], stats['abandoned']))
+
+        return top, min_score, max_score
+
+
+    def score_survivors(self, survivors, best, stats):
+        # Scores a batch of (order, candidate_id, channels, lower bounds) one
+        # channel at a time, as exact_score() does for a single candidate: the
+        # candidates whose bound exceeds the distance they need are dropped,
+        # and the others go through the backend together (banded backends
+        # abandon each of them beyond that distance). Returns
+        # [(order, candidate_id, score), ...].
+        if not survivors:
+            return []
+        weights = np.array([w for w, _, _ in survivors[0][2]], dtype=np.float64)
+        bounds  = np.array([distances for _, _, _, distances in survivors], dtype=np.float64)
+        similarities = weights / np.maximum(bounds, MIN_DISTANCE)
+        alive = np.ones(len(survivors), dtype=bool)
+        paid  = np.zeros(len(survivors), dtype=bool)
+        for i, weight in enumerate(weights):
+            rest = np.delete(similarities, i, axis=1).sum(axis=1)
+            max_costs = np.array([self.max_cost(weight, r, best) for r in rest])
+            skipped = alive & (bounds[:, i] > max_costs)
+            stats['lb_keogh' if self.backend.band is not None else 'lb_kim'] += int((skipped & ~paid).sum())
+            stats['abandoned'] += int((skipped & paid).sum())
+            alive &= ~skipped
+            indices = np.flatnonzero(alive)
+            if len(indices) == 0:
+                break
+            query_sequence = survivors[indices[0]][2][i][1]
+            distances = np.asarray(self.backend.distances(query_sequence, [survivors[j][2][i][2] for j in indices],
+                                                          max_costs[indices]), dtype=np.float64)
+            paid[indices] = True
+            similarities[indices, i] = weight / np.maximum(distances, MIN_DISTANCE)
+            # A fastdtw distance is always complete, so only the channels left
+            # out count as abandoned.
+            over = distances > max_costs[indices]
+            if i == len(weights) - 1:
+                over &= ~np.isfinite(distances)
+            stats['abandoned'] += int(over.sum())
+            alive[indices[over]] = False
+        return [(survivors[j][0], survivors[j][1], float(similarities[j].sum())) for j in np.flatnonzero(alive)]
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__    = 'Shion Tominaga and Akihiro Miyata'
+__copyright__ = 'Copyright (c) 2018-2021 Miyata Lab.'
+
+# Standard library imports.
+import itertools
+import pathlib
+import sys
+import threading as th
+from collections import Counter, defaultdict
+
+# Related third party imports.
+import numpy as np
+
+# Local application/library specific imports.
+current_dir = pathlib.Path(__file__).resolve().parent
+sys.path.append(str(current_dir))
+import embedding_index
+
+
+# Number of points the contour is resampled to before finding keypoints, and
+# width of the moving average applied to the turning angles.
+RESAMPLE_SIZE = 128
+SMOOTHING     = 5
+
+# Curvature extrema weaker than this turning angle (radians per point) are
+# ignored, and at most MAX_KEYPOINTS keypoints are kept per contour.
+CURVATURE_THRESHOLD = 0.02
+MAX_KEYPOINTS       = 8
+
+# Quantization steps of the relative geometry of pairs (as a ratio of the
+# contour width) and of triples (in the frame of their outer points).
+PAIR_CELL   = 0.05
+TRIPLE_CELL = 0.1
+
+
+def keypoints(shape_x, shape_y):
+    # Returns [(kind, x, y), ...] in contour order: both ends, the highest and
+    # lowest points (as HeightFeatureExtractor finds them) and the strongest
+    # curvature extrema, whose kind is their turning direction.
+    points = embedding_index.resample(shape_x, shape_y, RESAMPLE_SIZE)
+    found  = {0: 'end', len(points) - 1: 'end',
+              int(np.argmin(points[:, 1])): 'high',
+              int(np.argmax(points[:, 1])): 'low'}
+
+    segments = np.diff(points, axis=0)
+    turning  = np.diff(np.unwrap(np.arctan2(segments[:, 1], segments[:, 0])))
+    turning  = np.convolve(turning, np.ones(SMOOTHING) / SMOOTHING, mode='same')
+    strength = np.abs(turning)
+    # turning[i] is the turn at point i + 1.
+    extrema = [i for i in range(1, len(turning) - 1)
+               if strength[i] > CURVATURE_THRESHOLD and strength[i] >= strength[i - 1] and strength[i] >= strength[i + 1]]
+    extrema.sort(key=lambda i: strength[i], reverse=True)
+    for i in extrema:
+        if len(found) >= MAX_KEYPOINTS:
+            break
+        found.setdefault(i + 1, 'convex' if turning[i] > 0 else 'concave')
+    return [(found[i], points[i, 0], points[i, 1]) for i in sorted(found)]
+
+
+def hash_keys(points):
+    # Quantized relative geometry of every pair and triple of keypoints. Pairs
+    # are normalized by the contour width (translation and scale invariant);
+    # the middle point of a triple is expressed in the frame of the outer two
+    # (similarity invariant).
+    xy = np.array([(x, y) for _, x, y in points], dtype=np.float64)
+    kinds = [kind for kind, _, _ in points]
+    width = float(np.ptp(xy[:, 0])) or 1.0
+    keys = set()
+    for i, j in itertools.combinations(range(len(points)), 2):
+        dx, dy = (xy[j] - xy[i]) / width
+        keys.add(('pair', kinds[i], kinds[j], int(np.floor(dx / PAIR_CELL)), int(np.floor(dy / PAIR_CELL))))
+    for i, j, l in itertools.combinations(range(len(points)), 3):
+        base = xy[l] - xy[i]
+        norm = float(base @ base)
+        if norm == 0:
+            continue
+        offset = xy[j] - xy[i]
+        u = float(offset @ base) / norm
+        v = float(base[0] * offset[1] - base[1] * offset[0]) / norm
+        keys.add(('triple', kinds[i], kinds[j], kinds[l], int(np.floor(u / TRIPLE_CELL)), int(np.floor(v / TRIPLE_CELL))))
+    return keys
+
+
+def neighbours(key):
+    # The cell of key and the 8 cells around it, so that geometry close to a
+    # cell boundary still meets.
+    for du, dv in itertools.product((-1, 0, 1), repeat=2):
+        yield key[:-2] + (key[-2] + du, key[-1] + dv)
+
+
+def rarity(count, total):
+    # Vote weight of a key met by count of total candidates.
+    return float(np.log1p(total / count))
+
+
+def count_votes(query_keys, candidate_keys, counts=None, total=0):
+    # Votes of the query keys that meet one of the candidate's keys, weighted
+    # as GeometricHashIndex.vote() does when counts (the number of indexed
+    # candidates each query key meets) and total are given.
+    votes = 0.0
+    for key in query_keys:
+        if any(neighbour in candidate_keys for neighbour in neighbours(key)):
+            votes += rarity(counts[key] + 1, total + 1) if counts is not None else 1.0
+    return votes
+
+
+class GeometricHashIndex():
+    def __init__(self):
+        # Inverted index from hash keys to candidate IDs, and the keys of each
+        # candidate so that it can be removed.
+        self.postings = defaultdict(set)
+        self.keys_of  = {}
+        self.lock     = th.Lock()
+
+
+    def __len__(self):
+        return len(self.keys_of)
+
+
+    def __contains__(self, candidate_id):
+        return candidate_id in self.keys_of
+
+
+    def add(self, candidate_id, keys):
+        with self.lock:
+            self.discard(candidate_id)
+            self.keys_of[candidate_id] = keys
+            for key in keys:
+                self.postings[key].add(candidate_id)
+
+
+    def remove(self, candidate_id):
+        with self.lock:
+            self.discard(candidate_id)
+
+
+    def discard(self, candidate_id):
+        # The caller holds self.lock.
+        for key in self.keys_of.pop(candidate_id, ()):
+            self.postings[key].discard(candidate_id)
+            if not self.postings[key]:
+                del self.postings[key]
+
+
+    def vote(self, query_keys, allowed=None):
+        # Returns a Counter of votes by candidate ID. Each query key votes for
+        # the candidates it meets (see count_votes()), weighted by how rare it
+        # is in the gallery. Only the postings of the query keys are read, not
+        # the whole gallery.
+        votes = Counter()
+        with self.lock:
+            for key in query_keys:
+                met = set()
+                for neighbour in neighbours(key):
+                    met.update(self.postings.get(neighbour, ()))
+                if not met:
+                    continue
+                weight = rarity(len(met), len(self.keys_of))
+                for candidate_id in met if allowed is None else met & allowed:
+                    votes[candidate_id] += weight
+        return votes
+
+
+    def meet_counts(self, keys):
+        # Number of candidates each of keys meets, for count_votes().
+        with self.lock:
+            return {key: len(set().union(*(self.postings.get(neighbour, ()) for neighbour in neighbours(key))))
+                    for key in keys}
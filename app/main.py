@@ -31,6 +31,7 @@ class Env:
         self.server_params  = server_params
         self.matcher_params = matcher_params
         self.db_handler = db.DBHandler(*db_params)
+        self.db_handler.setup_schema()
 
 
     def start(self):
@@ -51,16 +52,28 @@ class Env:
         self.db_handler.set_chat_room_id_by_image_id(image_id, chat_room_id)
 
 
+    def claim_chat_room_id_by_image_id(self, image_id, claimer_id=None):
+        return self.db_handler.claim_chat_room_id_by_image_id(image_id, claimer_id)
+
+
+    def set_match_result(self, cmd, query_id, version, ranking):
+        self.db_handler.set_match_result(cmd, query_id, version, ranking)
+
+
+    def delete_session(self, session_id):
+        return self.db_handler.delete_session(session_id)
+
+
     def get_all_features(self):
         return self.db_handler.get_all_features()
 
 
-    def get_features_file_path_exists(self):
-        return self.db_handler.get_features_file_path_exists()
+    def get_features_file_path_exists(self, box=None, fp=None, since=None, session_id=None):
+        return self.db_handler.get_features_file_path_exists(box, fp, since, session_id)
 
 
-    def get_features_chat_room_id_exists(self):
-        return self.db_handler.get_features_chat_room_id_exists()
+    def get_features_chat_room_id_exists(self, box=None, fp=None, since=None, session_id=None):
+        return self.db_handler.get_features_chat_room_id_exists(box, fp, since, session_id)
 
 
     def get_features_by_image_id(self, image_id):
@@ -71,6 +84,22 @@ class Env:
         return self.db_handler.get_registered_date_by_image_id(image_id)
 
 
+    def get_match_version(self, cmd):
+        return self.db_handler.get_match_version(cmd)
+
+
+    def get_match_result(self, cmd, query_id, version):
+        return self.db_handler.get_match_result(cmd, query_id, version)
+
+
+    def get_claimed_chat_room_id_by_image_id(self, image_id):
+        return self.db_handler.get_claimed_chat_room_id_by_image_id(image_id)
+
+
+    def get_session_id_by_image_id(self, image_id):
+        return self.db_handler.get_session_id_by_image_id(image_id)
+
+
     def get_file_path_by_image_id(self, image_id):
         return self.db_handler.get_file_path_by_image_id(image_id)
 
@@ -118,8 +147,30 @@ if __name__ == "__main__":
     # Matcher parameters.
     weight_fs = float(conf.get('match', 'weight_fs'))
     digit     = int(conf.get('match', 'digit'))
+    cascade   = conf.getboolean('match', 'cascade')
+    workers   = int(conf.get('match', 'workers'))
+    backend   = conf.get('match', 'dtw_backend')
+    band      = float(conf.get('match', 'dtw_band'))
+    batch_size = int(conf.get('match', 'batch_size'))
+    multivariate = conf.getboolean('match', 'multivariate')
+    coarse_factors = [int(v) for v in conf.get('match', 'coarse_factors').split(',') if v.strip() != '']
+    coarse_top     = [int(v) for v in conf.get('match', 'coarse_top').split(',') if v.strip() != '']
+    audit_rate = float(conf.get('match', 'audit_rate'))
+    retrieval_k = int(conf.get('match', 'retrieval_k'))
+    hash_top    = int(conf.get('match', 'hash_top'))
+    box_tolerances = {name: float(conf.get('match', 'box_' + name)) for name in ('width', 'length', 'tilt')}
+    use_fp = conf.getboolean('match', 'use_fp')
+    prefilter_k = int(conf.get('match', 'prefilter_k'))
+    prefilter_weights = {name: float(conf.get('match', 'prefilter_' + name)) for name in ('fh', 'fa', 'width')}
+    deadline_ms = float(conf.get('match', 'deadline_ms'))
+    cache_size = int(conf.get('match', 'cache_size'))
+    cache_ttl  = float(conf.get('match', 'cache_ttl'))
+    window_minutes = float(conf.get('match', 'window_minutes'))
+    prematch = conf.getboolean('match', 'prematch')
     # DB parameters.
     dbName = conf.get('db', 'dbName')
+    busy_timeout_ms = float(conf.get('db', 'busy_timeout_ms'))
+    group_commit_ms = float(conf.get('db', 'group_commit_ms'))
 
     #--------------------------------#
     # Loads command line parameters. #
@@ -141,5 +192,25 @@ if __name__ == "__main__":
     #--------------------#
     logger.info('Port: %s' % port)
     logger.info('DB name: %s' % dbName)
-    env = Env(['', port], [weight_fs, digit], [dbName])
+    matcher_params = {'weight_fs': weight_fs,
+                      'digit': digit,
+                      'cascade': cascade,
+                      'band': band,
+                      'workers': workers,
+                      'backend': backend,
+                      'batch_size': batch_size,
+                      'multivariate': multivariate,
+                      'coarse_factors': coarse_factors,
+                      'coarse_top': coarse_top,
+                      'audit_rate': audit_rate,
+                      'retrieval_k': retrieval_k,
+                      'hash_top': hash_top,
+                      'box_tolerances': box_tolerances,
+                      'use_fp': use_fp,
+                      'prefilter_k': prefilter_k,
+                      'prefilter_weights': prefilter_weights,
+                      'cache_size': cache_size,
+                      'cache_ttl': cache_ttl if cache_ttl > 0 else None,
+                      'deadline': deadline_ms / 1000 if deadline_ms > 0 else None}
+    env = Env(['', port, window_minutes, prematch], matcher_params, [dbName, busy_timeout_ms / 1000, group_commit_ms / 1000])
     env.start()
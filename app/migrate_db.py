@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__    = 'Shion Tominaga and Akihiro Miyata'
+__copyright__ = 'Copyright (c) 2018-2021 Miyata Lab.'
+
+# Standard library imports.
+import argparse
+import configparser as cp
+import logging
+import logging.config
+import pathlib
+import sys
+
+# Local application/library specific imports.
+current_dir = pathlib.Path(__file__).resolve().parent
+sys.path.append(str(current_dir))
+import db
+
+
+logger = logging.getLogger(__name__)
+
+LOG_CONF_FILE    = 'conf/log.conf'
+SERVER_CONF_FILE = 'conf/server.conf'
+
+
+if __name__ == "__main__":
+    #-------------------------#
+    # Loads logging settings. #
+    #-------------------------#
+    logging.config.fileConfig(LOG_CONF_FILE, disable_existing_loggers=False)
+
+    #------------------------------------------------#
+    # Loads the DB name and command line parameters. #
+    #------------------------------------------------#
+    conf = cp.ConfigParser()
+    conf.read(SERVER_CONF_FILE)
+    parser = argparse.ArgumentParser(description='Converts the features stored as text in the paper table to BLOBs.')
+    parser.add_argument('--db',
+                        default=conf.get('db', 'dbName'),
+                        help='DB file')
+    parser.add_argument('--batch-size',
+                        type=int,
+                        default=1000,
+                        help='Rows converted per transaction')
+    args = parser.parse_args()
+
+    #--------------------------#
+    # Converts the paper rows. #
+    #--------------------------#
+    logger.info('Migrating DB: %s' % args.db)
+    db_handler = db.DBHandler(args.db)
+    db_handler.setup_schema()
+    count = db_handler.migrate_features(args.batch_size)
+    logger.info('Migrated %d rows.' % count)
+    print('Migrated %d rows.' % count)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__    = 'Shion Tominaga and Akihiro Miyata'
+__copyright__ = 'Copyright (c) 2018-2021 Miyata Lab.'
+
+# Standard library imports.
+import math
+
+
+# Scalar features of a tear, in the column order of the paper_rtree table:
+#   fh:     Height feature (see HeightFeatureExtractor).
+#   fa:     Angle feature (see AngleFeatureExtractor).
+#   width:  Horizontal distance between the ends of the tear (pixels).
+#   length: Length of the contour divided by its width.
+#   tilt:   Height difference of the ends divided by the width.
+# All of them are unchanged by mirroring the tear.
+SCALAR_NAMES = ('fh', 'fa', 'width', 'length', 'tilt')
+
+
+def to_values(values):
+    if type(values) is str:
+        return [float(value) for value in values.split(',')]
+    return [float(value) for value in values]
+
+
+def scalar_features(fs_x, fs_y, fh, fa):
+    # Returns the scalar features as a dict keyed by SCALAR_NAMES.
+    xs = to_values(fs_x)
+    ys = to_values(fs_y)
+    width  = abs(xs[-1] - xs[0])
+    length = sum(math.hypot(xs[i + 1] - xs[i], ys[i + 1] - ys[i]) for i in range(len(xs) - 1))
+    return {'fh': float(fh),
+            'fa': float(fa),
+            'width': width,
+            'length': length / width if width else 0.0,
+            'tilt': abs(ys[-1] - ys[0]) / width if width else 0.0
+            }
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__    = 'Shion Tominaga and Akihiro Miyata'
+__copyright__ = 'Copyright (c) 2018-2021 Miyata Lab.'
+
+# Standard library imports.
+import logging
+import multiprocessing as mp
+import threading as th
+
+# Related third party imports.
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+def worker_proc(conn, matcher):
+    # Runs in a forked process with its own copy of the matcher and of the
+    # candidates it had pre-parsed so far. It only runs NumPy and DTW code and
+    # logs on failure (logging reinitializes its locks after a fork). A worker
+    # restarted while the server runs may be forked while a request thread
+    # holds one of the matcher's locks, which nothing in this process would
+    # release, so they are replaced by new ones.
+    matcher.pool       = None
+    matcher.prune_lock = th.Lock()
+    for shared in (matcher.index, matcher.hash_index, matcher.scalar_index, matcher.cache):
+        if shared is not None:
+            shared.lock = th.Lock()
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'close':
+            break
+        try:
+            if msg[0] == 'add':
+                matcher.gallery.update(msg[1])
+                continue
+            if msg[0] == 'rank':
+                _, query, ids, k, use_fh, use_fa, use_fp = msg
+                before = dict(matcher.prune_stats)
+                candidates = {candidate_id: matcher.gallery[candidate_id] for candidate_id in ids}
+                result = matcher.rank(query, candidates, k, use_fh, use_fa, use_fp)
+                stats  = {key: matcher.prune_stats[key] - before[key] for key in before}
+                conn.send(('ok', result, stats))
+            if msg[0] == 'score':
+                _, queries, ids, use_fh, use_fa, use_fp = msg
+                candidates = {candidate_id: matcher.gallery[candidate_id] for candidate_id in ids}
+                conn.send(('ok', matcher.score_rows(queries, candidates, use_fh, use_fa, use_fp), None))
+        except Exception as e:
+            logger.exception('Scoring worker failed.')
+            conn.send(('error', e, None))
+    conn.close()
+
+
+class ScoringPool():
+    def __init__(self, workers, matcher):
+        # The workers are forked so that they start with the matcher's gallery
+        # without pickling it. New candidates are sent to every worker when
+        # they are first scored. A spawned worker would import the main
+        # module again, and with it the segmentation model.
+        self.ctx     = mp.get_context('fork')
+        self.matcher = matcher
+        self.conns = [None] * workers
+        self.procs = [None] * workers
+        # Candidate features held by the workers, by candidate ID.
+        self.known = dict(matcher.gallery)
+        self.lock  = th.Lock()
+        for i in range(workers):
+            self.start_worker(i)
+        logger.info('Scoring pool started ({} workers)'.format(workers))
+
+
+    def __len__(self):
+        return len(self.procs)
+
+
+    def start_worker(self, i):
+        # Forks worker i and sends it the candidates it did not inherit. The
+        # caller holds self.lock (or is the constructor).
+        parent_conn, child_conn = self.ctx.Pipe()
+        proc = self.ctx.Process(target=worker_proc, args=(child_conn, self.matcher), daemon=True)
+        proc.start()
+        child_conn.close()
+        self.conns[i] = parent_conn
+        self.procs[i] = proc
+        missing = {candidate_id: features for candidate_id, features in self.known.items()
+                   if self.matcher.gallery.get(candidate_id) is not features}
+        if missing:
+            parent_conn.send(('add', missing))
+
+
+    def restart_worker(self, i):
+        # Replaces worker i after it died. The caller holds self.lock.
+        logger.error('Scoring worker {} died (exit code: {}); restarting it.'.format(i, self.procs[i].exitcode))
+        self.conns[i].close()
+        self.procs[i].join(timeout=1)
+        self.start_worker(i)
+
+
+    def send(self, i, msg):
+        # The caller holds self.lock.
+        if not self.procs[i].is_alive():
+            self.restart_worker(i)
+        try:
+            self.conns[i].send(msg)
+        except (EOFError, OSError):
+            self.restart_worker(i)
+            self.conns[i].send(msg)
+
+
+    def exchange(self, msgs):
+        # Sends msgs[i] to worker i and returns their replies. A worker that
+        # dies before replying is restarted and given its message again. The
+        # caller holds self.lock.
+        for i, msg in enumerate(msgs):
+            self.send(i, msg)
+        replies = []
+        for i, msg in enumerate(msgs):
+            try:
+                replies.append(self.conns[i].recv())
+            except (EOFError, OSError):
+                self.restart_worker(i)
+                self.conns[i].send(msg)
+                replies.append(self.conns[i].recv())
+        return replies
+
+
+    def rank(self, query, candidates, k, use_fh, use_fa, use_fp):
+        # Shards the candidates over the workers and returns their partial
+        # results, each of which is (top, min_score, max_score, prune_stats).
+        ids = list(candidates)
+        with self.lock:
+            self.send_missing(candidates)
+            shards = [ids[i::len(self.conns)] for i in range(len(self.conns))]
+            replies = self.exchange([('rank', query, shard, k, use_fh, use_fa, use_fp) for shard in shards])
+
+        results = []
+        for status, result, stats in replies:
+            if status == 'error':
+                raise result
+            results.append((*result, stats))
+        return results
+
+
+    def score_rows(self, queries, candidates, use_fh, use_fa, use_fp):
+        # Shards the prepared queries over the workers and returns the score
+        # matrix of MatchingEngine.score_rows().
+        rows = list(queries.values())
+        ids  = list(candidates)
+        with self.lock:
+            self.send_missing(candidates)
+            shards = [list(range(i, len(rows), len(self.conns))) for i in range(len(self.conns))]
+            replies = self.exchange([('score', [rows[i] for i in shard], ids, use_fh, use_fa, use_fp) for shard in shards])
+
+        scores = np.full((len(rows), len(ids)), -np.inf)
+        for shard, (status, result, _) in zip(shards, replies):
+            if status == 'error':
+                raise result
+            scores[shard] = result
+        return scores
+
+
+    def send_missing(self, candidates):
+        # Sends the candidates the workers do not hold yet. The caller holds
+        # self.lock.
+        missing = {candidate_id: features for candidate_id, features in candidates.items()
+                   if self.known.get(candidate_id) is not features}
+        self.known.update(missing)
+        if missing:
+            for i in range(len(self.conns)):
+                self.send(i, ('add', missing))
+
+
+    def close(self):
+        with self.lock:
+            for conn in self.conns:
+                conn.send(('close',))
+                conn.close()
+        for proc in self.procs:
+            proc.join()
@@ -12,8 +12,11 @@ import json
 import logging
 import os
 import pathlib
+import queue
 import socketserver as scts
 import sys
+import threading as th
+from collections import OrderedDict
 from urllib.parse import urlparse
 
 # Local application/library specific imports.
@@ -26,16 +29,40 @@ import image_processing_manager as ipm
 
 logger = logging.getLogger(__name__)
 
+# Number of ranked candidates kept per query, and number of queries whose
+# rankings are kept (see TearingServer.rank()).
+RANKING_SIZE    = 5
+RANKING_ENTRIES = 256
+
+# Widest matching window tried before falling back to all the pieces (see
+# TearingServer.get_candidates()).
+WINDOW_LIMIT = dt.timedelta(days=7)
+
 
 class TearingServer(scts.ThreadingMixIn, scts.TCPServer):
     daemon_threads = True
     allow_reuse_address = True
 
-    def __init__(self, env, host, port, matcher_params, handler):
+    def __init__(self, env, host, port, window, prematch, matcher_params, handler):
         scts.TCPServer.__init__(self, (host, port), handler)
         self.env = env
-        self.matcher = engine.MatchingEngine(*matcher_params)
+        # Candidates are first looked for among the pieces registered at most
+        # window minutes before the query (0: all the pieces).
+        self.window = dt.timedelta(minutes=window) if window > 0 else None
+        self.matcher = engine.MatchingEngine(**matcher_params)
         self.image_util = image.ImageUtil()
+        self.rankings = OrderedDict()
+        self.rankings_lock = th.Lock()
+        # Matches in progress by (cmd, image_id, version), which identical
+        # requests wait for instead of matching again (see match_image()).
+        self.flights = {}
+        self.flights_lock = th.Lock()
+        # Newly registered pieces waiting to be matched in the background
+        # (see prematch_proc()).
+        self.prematch_queue = queue.Queue() if prematch else None
+        if prematch:
+            prematch_th = th.Thread(target=self.prematch_proc, daemon=True)
+            prematch_th.start()
         logger.info('Server start (port: %d)' % port)
         print('Serving at port: %d' % port)
 
@@ -52,16 +79,159 @@ class TearingServer(scts.ThreadingMixIn, scts.TCPServer):
         self.env.set_chat_room_id_by_image_id(image_id, chat_room_id)
 
 
+    def claim_chat_room_id_by_image_id(self, image_id, claimer_id=None):
+        return self.env.claim_chat_room_id_by_image_id(image_id, claimer_id)
+
+
+    def prematch(self, image_id):
+        # Queues a newly registered piece to be matched in the background.
+        if self.prematch_queue is not None:
+            self.prematch_queue.put(image_id)
+
+
+    def prematch_proc(self):
+        # Matches the queued pieces for each command while their users are
+        # still handling the paper. The rankings are kept by match_image(), so
+        # that download_file and enter_chat_room find them ready.
+        while True:
+            image_id = self.prematch_queue.get()
+            for cmd, getter in (('download_file', self.get_features_file_path_exists),
+                                ('enter_chat_room', self.get_features_chat_room_id_exists)):
+                try:
+                    self.match_image(cmd, image_id, getter, anytime=False)
+                except Exception:
+                    logger.exception('Failed to prematch image {} for {}.'.format(image_id, cmd))
+            logger.info('Prematched image {} ({} waiting).'.format(image_id, self.prematch_queue.qsize()))
+
+
+    def match_image(self, cmd, image_id, getter, anytime=True):
+        # Returns the ranking of image_id against the candidates getter (one
+        # of the get_features_*_exists() methods) returns, and whether it is
+        # exact. The exact rankings are kept in the DB and served again until
+        # the candidates of cmd change. anytime=False ignores the matching
+        # deadline. Concurrent requests for the same image, command and
+        # version share one match.
+        version = self.get_match_version(cmd)
+        stored  = self.get_match_result(cmd, image_id, version)
+        if stored is not None:
+            return stored, True
+
+        key = (cmd, image_id, version)
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = {'done': th.Event(), 'result': None, 'error': None}
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['result']
+        try:
+            flight['result'] = self.match_candidates(cmd, image_id, getter, version, anytime)
+            return flight['result']
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight['done'].set()
+
+
+    def match_candidates(self, cmd, image_id, getter, version, anytime):
+        input_features = self.get_features_by_image_id(image_id)
+        # スカラー特徴量が許容範囲内の紙片データを抜き出す
+        box = self.matcher.candidate_box(input_features, use_fh=self.matcher.prefilter_k <= 0)
+        fp  = input_features['position'] if self.matcher.use_fp else None
+        candidates = self.matcher.prepare_candidates(self.get_candidates(getter, image_id, box, fp), cache=True)
+        ranking, exact = self.rank(cmd, image_id, input_features, candidates, anytime)
+        if exact:
+            self.set_match_result(cmd, image_id, version, ranking)
+        return ranking, exact
+
+
+    def rank(self, cmd, image_id, input_features, candidates, anytime=True):
+        # Returns the ranking and whether it is exact. Reuses the ranking of a
+        # previous request for the same query as long as no candidate has
+        # appeared that was not scored then. Ranked pieces that are no longer
+        # candidates (e.g. claimed chat rooms) are dropped from it, and it is
+        # computed again once that leaves it shorter than a new ranking would
+        # be. With a matching deadline, rankings cut short by it are not kept.
+        key = (cmd, image_id)
+        with self.rankings_lock:
+            cached = self.rankings.get(key)
+            if cached is not None:
+                self.rankings.move_to_end(key)
+        if cached is not None and cached[1].issuperset(candidates):
+            ranking = [entry for entry in cached[0] if entry[0] in candidates]
+            if len(ranking) >= min(RANKING_SIZE, len(candidates)):
+                return ranking, True
+
+        if anytime and self.matcher.deadline is not None:
+            ranking, exact = self.matcher.match_anytime(input_features, candidates, RANKING_SIZE,
+                                                        use_fh=True, use_fp=self.matcher.use_fp, query_id=image_id)
+        else:
+            ranking, exact = self.matcher.match_topk(input_features, candidates, RANKING_SIZE,
+                                                     use_fh=True, use_fp=self.matcher.use_fp, query_id=image_id), True
+        if exact:
+            with self.rankings_lock:
+                self.rankings[key] = (ranking, frozenset(candidates))
+                if len(self.rankings) > RANKING_ENTRIES:
+                    self.rankings.popitem(last=False)
+        return ranking, exact
+
+
+    def get_candidates(self, getter, image_id, box=None, fp=None):
+        # Calls getter (one of the get_features_*_exists() methods) on the
+        # pieces of the query's session registered within self.window before
+        # the query. The window is doubled while it yields no candidates, up
+        # to WINDOW_LIMIT, and then the pieces of any date are returned.
+        session_id = self.get_session_id_by_image_id(image_id)
+        if self.window is None:
+            return getter(box, fp, session_id=session_id)
+        registered_date = dt.datetime.fromisoformat(str(self.get_registered_date_by_image_id(image_id)))
+        window = self.window
+        while window <= WINDOW_LIMIT:
+            candidates = getter(box, fp, registered_date - window, session_id)
+            if candidates:
+                return candidates
+            logger.info('No candidates within {}; widening the window.'.format(window))
+            window *= 2
+        return getter(box, fp, session_id=session_id)
+
+
+    def forget_session(self, session_id):
+        # Deletes the pieces of session_id from the DB, the matcher and the
+        # kept rankings. Returns the number of deleted pieces.
+        image_ids = set(self.delete_session(session_id))
+        self.matcher.forget(image_ids)
+        with self.rankings_lock:
+            for key in [key for key, (ranking, _) in self.rankings.items()
+                        if key[1] in image_ids or any(entry[0] in image_ids for entry in ranking)]:
+                del self.rankings[key]
+        logger.info('Session {} deleted ({} pieces).'.format(session_id, len(image_ids)))
+        return len(image_ids)
+
+
+    def set_match_result(self, cmd, query_id, version, ranking):
+        self.env.set_match_result(cmd, query_id, version, ranking)
+
+
+    def delete_session(self, session_id):
+        return self.env.delete_session(session_id)
+
+
     def get_all_features(self):
         return self.env.get_all_features()
 
 
-    def get_features_file_path_exists(self):
-        return self.env.get_features_file_path_exists()
+    def get_features_file_path_exists(self, box=None, fp=None, since=None, session_id=None):
+        return self.env.get_features_file_path_exists(box, fp, since, session_id)
 
 
-    def get_features_chat_room_id_exists(self):
-        return self.env.get_features_chat_room_id_exists()
+    def get_features_chat_room_id_exists(self, box=None, fp=None, since=None, session_id=None):
+        return self.env.get_features_chat_room_id_exists(box, fp, since, session_id)
 
 
     def get_features_by_image_id(self, image_id):
@@ -72,6 +242,22 @@ class TearingServer(scts.ThreadingMixIn, scts.TCPServer):
         return self.env.get_registered_date_by_image_id(image_id)
 
 
+    def get_match_version(self, cmd):
+        return self.env.get_match_version(cmd)
+
+
+    def get_match_result(self, cmd, query_id, version):
+        return self.env.get_match_result(cmd, query_id, version)
+
+
+    def get_claimed_chat_room_id_by_image_id(self, image_id):
+        return self.env.get_claimed_chat_room_id_by_image_id(image_id)
+
+
+    def get_session_id_by_image_id(self, image_id):
+        return self.env.get_session_id_by_image_id(image_id)
+
+
     def get_file_path_by_image_id(self, image_id):
         return self.env.get_file_path_by_image_id(image_id)
 
@@ -125,8 +311,10 @@ class TearingHandler(hs.SimpleHTTPRequestHandler):
                 # 特徴量をDBに保存し，image_idを取得
                 file_path = ''
                 chat_room_id = ''
-                data = [registered_date, *features.values(), file_path, chat_room_id]
+                session_id = form.getfirst('session_id', '')
+                data = [registered_date, *features.values(), file_path, chat_room_id, session_id]
                 image_id = int(self.server.register_and_get_image_id(data))
+                self.server.matcher.register(image_id, features)
 
                 # ファイルを保存, pathを取得してDBに格納
                 self.save_content_file(file_name, file_data)
@@ -148,6 +336,9 @@ class TearingHandler(hs.SimpleHTTPRequestHandler):
                     with open(chat_log_file_path, 'w') as f:
                         print('%s, The chat room was created.' % image_id, file=f)
 
+                # 受け取り操作の前にバックグラウンドでマッチングしておく
+                self.server.prematch(image_id)
+
                 # image_idとチャットルームidを返す
                 response_body = {
                     'cmd': cmd,
@@ -182,10 +373,16 @@ class TearingHandler(hs.SimpleHTTPRequestHandler):
                 features = self.extract_features(image)
                 file_path = ''
                 chat_room_id = ''
+                # イベントコード（任意）．同じセッションの紙片同士のみ照合する
+                session_id = form.getfirst('session_id', '')
 
-                data = [registered_date, *features.values(), file_path, chat_room_id]
+                data = [registered_date, *features.values(), file_path, chat_room_id, session_id]
 
                 image_id = self.server.register_and_get_image_id(data)
+                # マッチング用の特徴量（埋め込みを含む）を登録時に計算しておく
+                self.server.matcher.register(image_id, features)
+                # 受け取り操作の前にバックグラウンドでマッチングしておく
+                self.server.prematch(image_id)
 
                 response_body = {
                     'cmd': cmd,
@@ -243,22 +440,25 @@ class TearingHandler(hs.SimpleHTTPRequestHandler):
         elif cmd == 'download_file':
             try:
                 image_id = int(form['image_id'].value)
-                # 特徴量を抽出する
-                input_image_id_features = self.server.get_features_by_image_id(image_id)
-                # file_pathが存在する紙片データを抜き出す
-                candidates_features = self.server.get_features_file_path_exists()
-                # マッチング処理を行う
-                matched_image_id = self.server.matcher.match(input_image_id_features, candidates_features, use_fh=True)
+                # file_pathが存在する紙片とマッチング処理を行う（保存済みの結果があれば再利用する）
+                ranking, exact = self.server.match_image(cmd, image_id, self.server.get_features_file_path_exists)
+                # 上位の紙片から順にファイルを取得できるものを探す
+                file_path = ''
+                for matched_image_id, score, norm_score in ranking:
+                    file_path = self.server.get_file_path_by_image_id(matched_image_id)
+                    if file_path != '':
+                        break
+                if file_path == '':
+                    raise KeyError('No match was found.')
                 print('matched_image_id =', matched_image_id)
 
-                file_path = self.server.get_file_path_by_image_id(matched_image_id)
-
                 response_body = {
                     'cmd': cmd,
                     'data': {
                         'result': 'success',
                         'message': 'Successfully to download the file.',
-                        'file_path': file_path
+                        'file_path': file_path,
+                        'exact': exact
                     }
                 }
             except KeyError as e:
@@ -323,16 +523,20 @@ class TearingHandler(hs.SimpleHTTPRequestHandler):
                 image_id = int(form['image_id'].value)
                 # TODO:
                 # image_idの紙片とchat_room_idに値がある紙片でマッチングさせる
-                # 特徴量を抽出する
-                input_image_id_features = self.server.get_features_by_image_id(image_id)
-                # chat_room_idが存在する紙片データを抜き出す
-                candidates_features = self.server.get_features_chat_room_id_exists()
-                # マッチング処理を行う
-                matched_image_id = self.server.matcher.match(input_image_id_features, candidates_features, use_fh=True)
-                # マッチング相手のchat_room_idを返す
-                partner_chat_room_id = self.server.get_chat_room_id_by_image_id(matched_image_id)
-                # マッチング相手のchat_room_idを初期化する
-                self.server.set_chat_room_id_by_image_id(matched_image_id, '')
+                # マッチング処理を行う（保存済みの結果があれば再利用する）
+                # 再送されたリクエストには前回取得したチャットルームを返す
+                partner_chat_room_id = self.server.get_claimed_chat_room_id_by_image_id(image_id)
+                exact = True
+                if partner_chat_room_id == '':
+                    ranking, exact = self.server.match_image(cmd, image_id, self.server.get_features_chat_room_id_exists)
+                    # マッチング相手のchat_room_idを取得して初期化する
+                    # 他の紙片に先に取得されていた場合は次の候補を試す
+                    for matched_image_id, score, norm_score in ranking:
+                        partner_chat_room_id = self.server.claim_chat_room_id_by_image_id(matched_image_id, image_id)
+                        if partner_chat_room_id != '':
+                            break
+                if partner_chat_room_id == '':
+                    raise KeyError('No match was found.')
 
                 print('partner_chat_room_id = ', partner_chat_room_id)
                 response_body = {
@@ -340,7 +544,8 @@ class TearingHandler(hs.SimpleHTTPRequestHandler):
                     'data': {
                         'result': 'success',
                         'message': 'Successfully to enter the chat room.',
-                        'chat_room_id': partner_chat_room_id
+                        'chat_room_id': partner_chat_room_id,
+                        'exact': exact
                     }
                 }
             except:
@@ -448,6 +653,33 @@ class TearingHandler(hs.SimpleHTTPRequestHandler):
                     }
                 }
 
+        #----------------#
+        # delete_session #
+        #----------------#
+        elif cmd == 'delete_session':
+            try:
+                session_id = form['session_id'].value
+                # セッションの紙片をDBとマッチング用の索引から削除する
+                count = self.server.forget_session(session_id)
+                response_body = {
+                    'cmd': cmd,
+                    'data': {
+                        'result': 'success',
+                        'message': 'Successfully to delete the session.',
+                        'count': count
+                    }
+                }
+            except KeyError as e:
+                print(e)
+                response_body = {
+                    'cmd': cmd,
+                    'data': {
+                        'result': 'failure',
+                        'message': 'Failed to delete the session.',
+                        'count': 0
+                    }
+                }
+
         #--------------#
         # Invalid role #
         #--------------#
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__    = 'Shion Tominaga and Akihiro Miyata'
+__copyright__ = 'Copyright (c) 2018-2021 Miyata Lab.'
+
+# Standard library imports.
+import threading as th
+import time
+from collections import OrderedDict
+
+
+class SimilarityCache():
+    def __init__(self, size, ttl=None):
+        # Keeps up to size values, evicting the least recently used first.
+        # Values older than ttl seconds are dropped when looked up (None keeps
+        # them until evicted).
+        self.size    = size
+        self.ttl     = ttl
+        self.entries = OrderedDict()  # key -> (value, time stored)
+        self.lock    = th.Lock()
+        self.stats   = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get_many(self, keys):
+        # Returns the cached values of keys as a dict; missing and expired
+        # keys are left out.
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is not None and self.ttl is not None and now - entry[1] > self.ttl:
+                    del self.entries[key]
+                    self.stats['expirations'] += 1
+                    entry = None
+                if entry is None:
+                    self.stats['misses'] += 1
+                    continue
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                found[key] = entry[0]
+        return found
+
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+
+    def put_many(self, items):
+        now = time.monotonic()
+        with self.lock:
+            for key, value in items:
+                self.entries[key] = (value, now)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+
+    def hit_rate(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return self.stats['hits'] / lookups if lookups else 0.0
@@ -36,14 +36,22 @@ SRC_DIR     = './images'
 SRC_SND_DIR = os.path.join(SRC_DIR, 'sender')
 SRC_RCV_DIR = os.path.join(SRC_DIR, 'receiver')
 DST_DIR     = './m_result'
+# Worker processes that share the score matrix rows (0 scores them in this
+# process) and the DTW backend (see app/conf/server.conf). fastdtw is what the
+# server uses by default; the other backends give different scores, so the
+# backend is written to the result file.
+WORKERS     = os.cpu_count()
+DTW_BACKEND = 'fastdtw'
 
 
 class MatchingExperimenter():
-    def __init__(self, src_dir, src_snd_dir, src_rcv_dir, dst_dir):
+    def __init__(self, src_dir, src_snd_dir, src_rcv_dir, dst_dir, workers=0, backend='fastdtw'):
         self.src_dir     = src_dir
         self.src_snd_dir = src_snd_dir
         self.src_rcv_dir = src_rcv_dir
         self.dst_dir     = dst_dir
+        self.workers     = workers
+        self.backend     = backend
 
 
     def extract_features(self, src_img):
@@ -98,7 +106,7 @@ class MatchingExperimenter():
 
 
     def execute(self):
-        self.matcher = engine.MatchingEngine(weight_fs=1.0, digit=3)
+        self.matcher = engine.MatchingEngine(weight_fs=1.0, digit=3, workers=self.workers, backend=self.backend)
         # if not os.path.isfile('senders.pickle') or not os.path.isfile('receivers.pickle'):
         #     print('Start extracting features...')
         #     senders   = self.extract_features_in_dir(self.src_snd_dir)
@@ -118,18 +126,15 @@ class MatchingExperimenter():
         receivers = self.extract_features_in_dir(self.src_rcv_dir)
 
         print('Start matching...')
-        # 各Sender紙片を全Receiver紙片に対してマッチングさせる。
-        print('Sender-Receivers')
-        s_matches = {}
-        for s_name, s_features in senders.items():
-            matched_name = self.matcher.match(s_features, receivers, use_fh=True, use_fa=False, use_fp=False)
-            s_matches[s_name] = matched_name
-        # 各Receiver紙片を全Sender紙片に対してマッチングさせる。
-        print('Receiver-Senders')
-        r_matches = {}
-        for r_name, r_features in receivers.items():
-            matched_name = self.matcher.match(r_features, senders, use_fh=True, use_fa=False, use_fp=False)
-            r_matches[r_name] = matched_name
+        # 全Sender紙片と全Receiver紙片の類似度行列を一度だけ計算する。
+        scores = self.matcher.match_many(senders, receivers, use_fh=True, use_fa=False, use_fp=False)
+        if self.matcher.pool is not None:
+            self.matcher.pool.close()
+        # 各Sender紙片に最も類似するReceiver紙片（行ごとの最大）。
+        s_matches = scores.row_argmax()
+        # 各Receiver紙片に最も類似するSender紙片（列ごとの最大）。
+        # Sender側を反転して計算した類似度のため，逆向きのマッチングの近似となる。
+        r_matches = scores.column_argmax()
 
         # 結果をファイル出力。
         now = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -138,6 +143,7 @@ class MatchingExperimenter():
             print('#==========#', file=f)
             print('#  RESULT  #', file=f)
             print('#==========#', file=f)
+            print('DTW Backend: {}'.format(self.backend), file=f)
             # Both
             both_success_rate = self.calc_both_success_rate(s_matches, r_matches)
             print('Both Success: {}%'.format(both_success_rate), file=f)
@@ -160,6 +166,8 @@ if __name__ == '__main__':
         src_dir    =SRC_DIR,
         src_snd_dir=SRC_SND_DIR,
         src_rcv_dir=SRC_RCV_DIR,
-        dst_dir    =DST_DIR
+        dst_dir    =DST_DIR,
+        workers    =WORKERS,
+        backend    =DTW_BACKEND
         )
     me.execute()
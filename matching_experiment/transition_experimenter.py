@@ -102,7 +102,9 @@ class TransitionExperimenter():
                             src_dir=os.path.join(num_dir),
                             src_snd_dir=os.path.join(num_dir, 'sender'),
                             src_rcv_dir=os.path.join(num_dir, 'receiver'),
-                            dst_dir=os.path.join(num_dir, 'result')
+                            dst_dir=os.path.join(num_dir, 'result'),
+                            workers=me.WORKERS,
+                            backend=me.DTW_BACKEND
                         )
             matcher.execute()
 